@@ -0,0 +1,314 @@
+from quart import Blueprint, Quart, current_app, jsonify, request, Response
+from pymongo import AsyncMongoClient
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
+import os
+import json
+import httpx
+
+from llm_news_common import (
+    LLM_NEWS_INDEX, MONGO_POOL_SIZE, NO_RAG_DB, RAG_DB, STREAM_PAGE_SIZE, SYNTHETIC_PROJECTION,
+    bulk_response, bulk_write_errors, data_engine_url, has_unique_index, llm_news_response,
+    merge_synthetic_news, missing_unique_index_error, mongo_uri, prepare_bulk, record_bulk_outcome,
+    stored_cache_keys, window_bounds, window_cache_keys, window_params,
+)
+from response_cache import AsyncCacheVersions, ResponseCache, is_settled
+
+# Async version of the Context Manager API (Quart + pymongo AsyncMongoClient + httpx), with the
+# same routes and response bodies as api_llm_news.py. A request waiting on data_engine or
+# MongoDB does not hold a worker, so a few processes serve many concurrent exports.
+#
+#   uvicorn --factory api_llm_news_async:create_app --host 0.0.0.0 --port 7000 --workers 4
+
+# Connection pool, timeouts and retries for the calls to data_engine
+HTTP_POOL_SIZE = int(os.environ.get("HTTP_POOL_SIZE", 64))
+HTTP_TIMEOUT = httpx.Timeout(float(os.environ.get("HTTP_READ_TIMEOUT", 60)), connect=float(os.environ.get("HTTP_CONNECT_TIMEOUT", 5)))
+HTTP_RETRIES = int(os.environ.get("HTTP_RETRIES", 3))
+
+bp = Blueprint('context_manager_async', __name__)
+
+# Responses of windows that are already over (see response_cache.py)
+response_cache = ResponseCache()
+
+
+# Clients of the worker, created inside its event loop when it starts serving
+def data_engine_client():
+    return current_app.config['DATA_ENGINE_CLIENT']
+
+
+def get_rag_db():
+    return current_app.config['MONGO_CLIENT'][RAG_DB]
+
+
+def get_no_rag_db():
+    return current_app.config['MONGO_CLIENT'][NO_RAG_DB]
+
+
+def cache_versions():
+    return AsyncCacheVersions(current_app.config['MONGO_CLIENT'])
+
+
+# Fetches raw news data from the external API for a specific date range.
+# 'limit' and 'after' request one page of the window (see data_engine pagination).
+async def read_newspaper_news(newspaper, date, start_hour, start_minute, end_hour, end_minute, limit=None, after=None):
+
+    params = window_params(date, start_hour, start_minute, end_hour, end_minute, limit, after)
+    try:
+        response = await data_engine_client().get(data_engine_url(newspaper), params=params)
+        response.raise_for_status()
+        return response.json()
+    except (httpx.HTTPError, ValueError) as e:
+        print(f"Error calling endpoint: {e}")
+        return None
+
+
+indexed_collections = set()
+# Collections whose unique index could not be created because they hold duplicated generations
+collections_without_unique_index = set()
+
+# Creates the unique lookup index on a newspaper collection (once per process) and returns
+# whether the collection has it. Collections written before it existed may hold duplicated
+# generations: they keep a plain lookup index, a warning is printed and the insert endpoints
+# refuse to write into them (the generators retry POSTs after timeouts and would store the
+# generation twice) until an operator runs dedupe_llm_news.py. Nothing is deleted here.
+async def ensure_indexes(collection):
+    key = (collection.database.name, collection.name)
+    if key in collections_without_unique_index:
+        # The migration may have run since the last refused insert
+        if not has_unique_index(await collection.index_information()):
+            return False
+        collections_without_unique_index.discard(key)
+    if key not in indexed_collections:
+        try:
+            await collection.create_index(LLM_NEWS_INDEX, unique=True)
+        except OperationFailure as e:
+            print(f"WARNING: unique index not created on {collection.database.name}.{collection.name} ({e}). "
+                  f"Inserts into it are refused until dedupe_llm_news.py is run.")
+            collections_without_unique_index.add(key)
+            try:
+                await collection.create_index(LLM_NEWS_INDEX)
+            except OperationFailure as e:
+                print(f"Lookup index not created on {collection.database.name}.{collection.name}: {e}")
+            return False
+        indexed_collections.add(key)
+    return True
+
+# Makes sure every existing newspaper collection has its indexes at startup
+async def create_indexes():
+    for database in (get_rag_db(), get_no_rag_db()):
+        for name in await database.list_collection_names():
+            await ensure_indexes(database[name])
+
+
+# Response of a cache entry, or 304 when the client already has it (If-None-Match)
+def cached_response(entry, cache_status):
+    if request.if_none_match.contains(entry.etag):
+        response = Response(b"", status=304)
+    else:
+        response = Response(entry.body, mimetype=entry.mimetype)
+    response.set_etag(entry.etag)
+    response.headers['X-Cache'] = cache_status
+    return response
+
+
+# Invalidates the cached windows that contain the stored synthetic news
+async def invalidate_cache(newspaper, rag, documents):
+    try:
+        await cache_versions().bump(stored_cache_keys(newspaper, rag, documents))
+    except Exception as e:
+        print(f"Could not invalidate the response cache of {newspaper}: {e}")
+
+
+# Endpoint to save a news item into the database (RAG or No-RAG collection)
+@bp.route('/newsLLM/<newspaper>', methods=['POST'])
+async def insert_document(newspaper):
+
+    try:
+        data = await request.get_json(force=True)
+
+        if not data:
+            return jsonify({"error": "No valid JSON received"}), 400
+
+        # Check if RAG flag is 1
+        if int(data.get("RAG", "")) == 1:
+            collection = get_rag_db()[newspaper]
+        else:
+            collection = get_no_rag_db()[newspaper]
+
+        if not await ensure_indexes(collection):
+            return jsonify({"error": missing_unique_index_error(collection.database.name, newspaper)}), 409
+        try:
+            result = await collection.insert_one(data)
+        except DuplicateKeyError:
+            return jsonify({
+                "message": f"Document already stored in '{newspaper}'",
+                "duplicate": True,
+                "id_news": data.get("id_news", "N/A"),
+            }), 200
+
+        await invalidate_cache(newspaper, data.get("RAG"), [data])
+        return jsonify({
+            "message": f"Document inserted successfully in '{newspaper}'",
+            "inserted_id": str(result.inserted_id),
+            "id_news": data.get("id_news", "N/A"),
+        }), 201
+
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+# Endpoint to save a batch of news items in one request (see api_llm_news.insert_documents)
+@bp.route('/newsLLM/<newspaper>/bulk', methods=['POST'])
+async def insert_documents(newspaper):
+
+    bulk = prepare_bulk(await request.get_json(force=True, silent=True))
+    if bulk is None:
+        return jsonify({"error": "Expected a non-empty JSON array of documents"}), 400
+    data, results, groups = bulk
+
+    for rag, indexes in groups.items():
+        if not indexes:
+            continue
+        collection = get_rag_db()[newspaper] if rag == 1 else get_no_rag_db()[newspaper]
+        documents = [data[i] for i in indexes]
+        failed = {}
+        duplicates = set()
+        try:
+            if await ensure_indexes(collection):
+                await collection.insert_many(documents, ordered=False)
+            else:
+                error = missing_unique_index_error(collection.database.name, newspaper)
+                failed = {position: error for position in range(len(documents))}
+        except BulkWriteError as e:
+            failed, duplicates = bulk_write_errors(e.details)
+        except Exception as e:
+            failed = {position: str(e) for position in range(len(documents))}
+        record_bulk_outcome(results, indexes, documents, failed, duplicates)
+        stored = [documents[position] for position, i in enumerate(indexes) if "inserted_id" in results[i]]
+        if stored:
+            await invalidate_cache(newspaper, rag, stored)
+
+    body, status = bulk_response(newspaper, results)
+    return jsonify(body), status
+
+# Joins a list of real news with their synthetic entries using one $in query,
+# keeping the real news order
+async def join_synthetic_news(collection, real_news, rag):
+    news_ids = [item.get("_id") for item in real_news]
+    synthetic_entries = []
+    if news_ids:
+        synthetic_entries = await collection.find({"id_news": {"$in": news_ids}}, SYNTHETIC_PROJECTION).to_list(None)
+    return merge_synthetic_news(real_news, synthetic_entries, rag)
+
+# Joined entries of a window, reading the real news from data_engine page by page.
+# state["complete"] is set to False when a page could not be read.
+async def iter_window_entries(collection, newspaper, date, start_hour, start_minute, end_hour, end_minute, rag, limit, after, state):
+    token = after
+    while True:
+        page = await read_newspaper_news(newspaper, date, start_hour, start_minute, end_hour, end_minute, limit or STREAM_PAGE_SIZE, token)
+        if not page:
+            state["complete"] = page is not None
+            break
+        for entry in await join_synthetic_news(collection, page.get("items", []), rag):
+            yield entry
+        token = page.get("next_after")
+        if limit or not token:
+            break
+
+# Retrieves real news and merges them with the LLM-generated data stored in MongoDB
+@bp.route('/newsLLM/<newspaper>', methods=['GET'])
+async def get_llm_news(newspaper):
+
+    rag = request.args.get('rag')
+    date = request.args.get('date')              # dd-mm-yyyy
+    start_hour = request.args.get('shour')   # start hour (0-23)
+    start_minute = request.args.get('sminute') # start minute (0-59)
+    end_hour = request.args.get('ehour')       # end hour optional (0-23)
+    end_minute = request.args.get('eminute')   # end minute optional (0-59)
+
+    if int(rag) == 1:
+        collection = get_rag_db()[newspaper]
+    else:
+        collection = get_no_rag_db()[newspaper]
+
+    # Optional pagination over the real news of the window ('limit' + 'after' resume token)
+    limit = request.args.get('limit')
+    after = request.args.get('after')
+
+    # Windows that are over are answered from the response cache. The key carries the
+    # versions of the real and synthetic news of the window days.
+    cache_key = None
+    bounds = window_bounds(date, start_hour, start_minute, end_hour, end_minute)
+    if bounds and is_settled(bounds[1]):
+        cache_key = f"{request.full_path}|{await cache_versions().tag(window_cache_keys(newspaper, rag, bounds))}"
+        entry = response_cache.get(cache_key)
+        if entry is not None:
+            return cached_response(entry, 'HIT')
+
+    # NDJSON streaming mode: pages of real news are read from data_engine and the joined
+    # entries are written as they are produced
+    if request.args.get('format') == 'ndjson':
+        state = {"complete": True}
+        entries = iter_window_entries(collection, newspaper, date, start_hour, start_minute, end_hour, end_minute, rag, limit, after, state)
+        if cache_key is None:
+            async def generate():
+                async for entry in entries:
+                    yield json.dumps(entry, ensure_ascii=False) + "\n"
+            return Response(generate(), mimetype='application/x-ndjson')
+        body = "".join([json.dumps(entry, ensure_ascii=False) + "\n" async for entry in entries]).encode('utf-8')
+        if not state["complete"]:
+            return Response(body, mimetype='application/x-ndjson')
+        return cached_response(response_cache.put(cache_key, body, 'application/x-ndjson'), 'MISS')
+
+    news_response = await read_newspaper_news(newspaper, date, start_hour, start_minute, end_hour, end_minute, limit, after)
+    real_news = news_response.get("items") if news_response else []
+    entries = await join_synthetic_news(collection, real_news, rag)
+
+    response = jsonify(llm_news_response(newspaper, date, start_hour, start_minute, end_hour, end_minute, entries, news_response))
+    # Responses built without data_engine are not cached
+    if cache_key is not None and news_response is not None:
+        return cached_response(response_cache.put(cache_key, await response.get_data(), response.mimetype), 'MISS')
+    return response
+
+
+# Empties the response cache of this worker and the shared cache directory (manual reset).
+@bp.route('/cache', methods=['DELETE'])
+async def clear_cache():
+    response_cache.clear()
+    return jsonify({"message": "Response cache cleared"}), 200
+
+
+# Response cache counters of this worker
+@bp.route('/cache', methods=['GET'])
+async def cache_stats():
+    return jsonify(response_cache.summary())
+
+
+# Application factory. The MongoDB and HTTP clients belong to the event loop of each worker,
+# so they are opened when the worker starts serving and closed when it stops.
+def create_app():
+    app = Quart(__name__)
+    app.register_blueprint(bp)
+
+    @app.before_serving
+    async def open_clients():
+        app.config['MONGO_CLIENT'] = AsyncMongoClient(mongo_uri(), maxPoolSize=MONGO_POOL_SIZE)
+        app.config['DATA_ENGINE_CLIENT'] = httpx.AsyncClient(
+            timeout=HTTP_TIMEOUT,
+            limits=httpx.Limits(max_connections=HTTP_POOL_SIZE, max_keepalive_connections=HTTP_POOL_SIZE),
+            transport=httpx.AsyncHTTPTransport(retries=HTTP_RETRIES),
+        )
+        try:
+            await create_indexes()
+        except Exception as e:
+            print(f"Could not create indexes at startup: {e}")
+
+    @app.after_serving
+    async def close_clients():
+        await app.config['DATA_ENGINE_CLIENT'].aclose()
+        await app.config['MONGO_CLIENT'].close()
+
+    return app
+
+
+if __name__ == '__main__':
+    # Development server
+    create_app().run(host='0.0.0.0', port=7000)
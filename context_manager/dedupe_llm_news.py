@@ -0,0 +1,69 @@
+import argparse
+
+from pymongo import MongoClient
+
+from llm_news_common import (
+    DUPLICATES_PIPELINE, LLM_NEWS_INDEX, NO_RAG_DB, RAG_DB, duplicate_ids, has_unique_index,
+    mongo_uri, newspaper_cache_keys, plain_index_names,
+)
+from response_cache import CacheVersions
+
+# One-off migration of the synthetic news collections written before the unique
+# (id_news, id_feature, id_llm) index existed. The API refuses inserts into a collection that
+# holds duplicated generations (see api_llm_news.ensure_indexes); this script keeps the oldest
+# copy of each generation, replaces the plain lookup index with the unique one and invalidates
+# the cached windows of the newspaper. The running API picks up the new index on the next
+# insert, no restart is needed.
+#
+# Without --apply it only reports what would be removed:
+#   docker compose exec context_manager python dedupe_llm_news.py [--newspaper elpais] [--apply]
+
+DELETE_BATCH = 1000
+
+
+# Removes the duplicated generations of one collection and creates its unique index.
+# Returns the number of duplicated documents found.
+def dedupe_collection(client, collection, rag, apply):
+    name = f"{collection.database.name}.{collection.name}"
+    if has_unique_index(collection.index_information()):
+        print(f"{name}: unique index already present")
+        return 0
+
+    duplicates = duplicate_ids(list(collection.aggregate(DUPLICATES_PIPELINE, allowDiskUse=True)))
+    if not apply:
+        print(f"{name}: {len(duplicates)} duplicated generations would be removed")
+        return len(duplicates)
+
+    # Inserts into this collection are refused until the unique index exists, so no new
+    # duplicate can be written between the deletes and create_index
+    for i in range(0, len(duplicates), DELETE_BATCH):
+        collection.delete_many({"_id": {"$in": duplicates[i:i + DELETE_BATCH]}})
+    for index_name in plain_index_names(collection.index_information()):
+        collection.drop_index(index_name)
+    collection.create_index(LLM_NEWS_INDEX, unique=True)
+    if duplicates:
+        CacheVersions(client).bump(newspaper_cache_keys(collection.name, rag))
+    print(f"{name}: removed {len(duplicates)} duplicated generations, unique index created")
+    return len(duplicates)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Remove duplicated synthetic news and create the unique index.")
+    parser.add_argument("--newspaper", help="Only this newspaper (default: every collection).")
+    parser.add_argument("--apply", action="store_true", help="Delete the duplicates. Without it the script only reports them.")
+    args = parser.parse_args()
+
+    client = MongoClient(mongo_uri())
+    total = 0
+    for database_name, rag in ((RAG_DB, 1), (NO_RAG_DB, 0)):
+        database = client[database_name]
+        for name in database.list_collection_names():
+            if args.newspaper and name != args.newspaper:
+                continue
+            total += dedupe_collection(client, database[name], rag, args.apply)
+
+    if args.apply:
+        print(f"Removed {total} duplicated generations")
+    else:
+        print(f"{total} duplicated generations found. Run again with --apply to remove them.")
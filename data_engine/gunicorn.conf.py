@@ -0,0 +1,15 @@
+import multiprocessing
+import os
+
+# gunicorn settings of the Data Engine API. Every worker is a separate process with its own
+# MongoClient (created after the fork), so throughput grows with GUNICORN_WORKERS.
+
+bind = os.environ.get("GUNICORN_BIND", "0.0.0.0:5000")
+workers = int(os.environ.get("GUNICORN_WORKERS", multiprocessing.cpu_count() * 2 + 1))
+# Threads per worker: requests mostly wait on MongoDB
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS", 4))
+# NDJSON streams of long windows can take a while
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", 300))
+keepalive = 5
+accesslog = "-"
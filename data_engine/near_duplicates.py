@@ -0,0 +1,119 @@
+import hashlib
+import re
+import unicodedata
+from datetime import datetime
+from bson import ObjectId
+
+# Near-duplicate detection for ingested news. The same wire story published by several
+# newspapers, or re-published with small edits, is grouped in one cluster so the generators
+# can produce synthetic text once per cluster.
+#
+# Each entry gets a fingerprint (hash of the normalized text, catches exact copies) and a
+# 64-bit SimHash over the words (catches small edits; longer shingles proved too sensitive
+# for headline + description sized texts). Two texts are near-duplicates when
+# their SimHashes differ in at most MAX_HAMMING_DISTANCE bits. The SimHash is split into
+# SIMHASH_BANDS bands: near-duplicates share at least one band, so candidates are found with
+# an indexed lookup on the bands instead of a full scan.
+
+SIMHASH_BITS = 64
+SIMHASH_BANDS = 4
+MAX_HAMMING_DISTANCE = 3
+SHINGLE_SIZE = 1
+
+# Clusters live in their own database: every collection of newspapers_db is a newspaper
+CLUSTERS_DB = 'newspapers_meta'
+CLUSTERS_COLLECTION = 'news_clusters'
+
+
+# Lowercase, without HTML tags, accents, punctuation or repeated spaces.
+def normalize_text(text):
+    text = re.sub(r'<[^>]+>', ' ', text or '')
+    text = unicodedata.normalize('NFKD', text.lower())
+    text = ''.join(c for c in text if not unicodedata.combining(c))
+    text = re.sub(r'[^\w\s]', ' ', text)
+    return re.sub(r'\s+', ' ', text).strip()
+
+
+# Exact identity of an entry (raw headline + description), backed by a unique index
+# in every newspaper collection.
+def content_hash(headline, description):
+    return hashlib.sha1(f"{headline}\x1f{description}".encode('utf-8')).hexdigest()
+
+
+def text_fingerprint(normalized):
+    return hashlib.sha1(normalized.encode('utf-8')).hexdigest()
+
+
+def _hash64(token):
+    return int.from_bytes(hashlib.blake2b(token.encode('utf-8'), digest_size=8).digest(), 'big')
+
+
+def simhash(normalized, shingle_size=SHINGLE_SIZE):
+    words = normalized.split()
+    if len(words) < shingle_size:
+        shingles = [' '.join(words)] if words else []
+    else:
+        shingles = [' '.join(words[i:i + shingle_size]) for i in range(len(words) - shingle_size + 1)]
+
+    weights = [0] * SIMHASH_BITS
+    for shingle in shingles:
+        h = _hash64(shingle)
+        for bit in range(SIMHASH_BITS):
+            weights[bit] += 1 if (h >> bit) & 1 else -1
+
+    value = 0
+    for bit in range(SIMHASH_BITS):
+        if weights[bit] > 0:
+            value |= 1 << bit
+    return value
+
+
+def hamming_distance(a, b):
+    return bin(a ^ b).count('1')
+
+
+# Band keys "<band>:<value>" of a SimHash, stored as a multikey index.
+def simhash_bands(value):
+    width = SIMHASH_BITS // SIMHASH_BANDS
+    mask = (1 << width) - 1
+    return [f"{band}:{(value >> (band * width)) & mask}" for band in range(SIMHASH_BANDS)]
+
+
+# Assigns news entries to near-duplicate clusters stored in MongoDB.
+class ClusterIndex:
+    def __init__(self, client):
+        self.collection = client[CLUSTERS_DB][CLUSTERS_COLLECTION]
+        self.collection.create_index('fingerprint')
+        self.collection.create_index('bands')
+
+    # Returns (cluster_id, fingerprint) for a headline + description, creating a new
+    # cluster when no near-duplicate exists.
+    def assign(self, headline, description, newspaper):
+        normalized = normalize_text(f"{headline} {description}")
+        fingerprint = text_fingerprint(normalized)
+        value = simhash(normalized)
+
+        cluster = self.collection.find_one({'fingerprint': fingerprint}, {'_id': 1})
+        if cluster is None:
+            candidates = self.collection.find({'bands': {'$in': simhash_bands(value)}}, {'_id': 1, 'simhash': 1})
+            for candidate in candidates:
+                if hamming_distance(value, int(candidate['simhash'], 16)) <= MAX_HAMMING_DISTANCE:
+                    cluster = candidate
+                    break
+
+        if cluster is None:
+            cluster_id = ObjectId()
+            self.collection.insert_one({
+                '_id': cluster_id,
+                'fingerprint': fingerprint,
+                'simhash': format(value, '016x'),
+                'bands': simhash_bands(value),
+                'newspaper': newspaper,
+                'first_seen': int(datetime.now().timestamp()),
+                'size': 1,
+            })
+        else:
+            cluster_id = cluster['_id']
+            self.collection.update_one({'_id': cluster_id}, {'$inc': {'size': 1}})
+
+        return str(cluster_id), fingerprint
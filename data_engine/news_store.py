@@ -0,0 +1,101 @@
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+from near_duplicates import content_hash
+
+# Storage of RSS entries in the newspaper collections, shared by the live ingestion
+# (engine.py) and the archive replay (rss_archive.py). Deduplication is set based: one
+# indexed lookup on content_hash per feed and an unordered insert_many, with the unique
+# index rejecting any duplicate left.
+
+# Day-window queries filter on date_stored and paginate on (date_stored, _id)
+DATE_STORED_INDEX = [('date_stored', 1), ('_id', 1)]
+
+# Collections whose indexes are already created in this process
+prepared_collections = set()
+
+
+# Credential management utility.
+def load_credentials(path='login.txt'):
+    creds = {}
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if '=' in line:
+                key, value = line.strip().split('=', 1)
+                creds[key.strip()] = value.strip()
+    return creds.get('user'), creds.get('password')
+
+
+# Indexes of a newspaper collection: the time index used by GET /news and the unique
+# content_hash index. The content_hash index is partial, so legacy entries that are exact
+# duplicates of another one stay without hash (see backfill_content_hashes).
+def create_news_indexes(collection):
+    collection.create_index(DATE_STORED_INDEX)
+    collection.create_index('content_hash', unique=True, partialFilterExpression={'content_hash': {'$exists': True}})
+
+
+# Creates the indexes of a newspaper collection (once per process).
+def prepare_collection(collection):
+    if collection.name in prepared_collections:
+        return
+    create_news_indexes(collection)
+    prepared_collections.add(collection.name)
+
+
+# One-off migration (engine.py --backfill_hashes): fills the hash of the entries stored before
+# the content_hash index existed. Entries that duplicate an already hashed one cannot take the
+# hash; they get content_hash_duplicate_of = _id of that entry instead, so they are not
+# scanned again. Returns (hashed, duplicates).
+def backfill_content_hashes(collection):
+    create_news_indexes(collection)
+    hashed = 0
+    duplicates = 0
+    pending = {'content_hash': {'$exists': False}, 'content_hash_duplicate_of': {'$exists': False}}
+    for entry in collection.find(pending, {'headline': 1, 'description': 1}).sort('date_stored', 1):
+        digest = content_hash(entry.get('headline'), entry.get('description'))
+        try:
+            collection.update_one({'_id': entry['_id']}, {'$set': {'content_hash': digest}})
+            hashed += 1
+        except DuplicateKeyError:
+            original = collection.find_one({'content_hash': digest}, {'_id': 1})
+            collection.update_one({'_id': entry['_id']}, {'$set': {'content_hash_duplicate_of': original['_id'] if original else None}})
+            duplicates += 1
+    return hashed, duplicates
+
+
+# Inserts the new entries of one feed snapshot (feedparser entries or their JSON dicts).
+# Returns the number of inserted entries.
+def store_entries(collection, clusters, name, feed_entries, epoch_time):
+    prepare_collection(collection)
+
+    # Set-based dedup: one indexed lookup for all the hashes of the feed
+    by_hash = {}
+    for entry in feed_entries:
+        headline = entry.get('title', 'No title')
+        description = entry.get('description', entry.get('summary', 'No description'))
+        by_hash.setdefault(content_hash(headline, description), (headline, description))
+
+    stored = {doc['content_hash'] for doc in collection.find({'content_hash': {'$in': list(by_hash)}}, {'content_hash': 1, '_id': 0})}
+
+    entries = []
+    for digest, (headline, description) in by_hash.items():
+        if digest in stored:
+            continue
+        cluster_id, fingerprint = clusters.assign(headline, description, name)
+        new_entry = {
+            'headline': headline,
+            'description': description,
+            'date_stored': epoch_time,
+            'content_hash': digest,
+            'cluster_id': cluster_id,
+            'text_fingerprint': fingerprint
+        }
+        entries.append(new_entry)
+
+    if not entries:
+        return 0
+
+    # The unique index rejects any duplicate that slipped in since the lookup
+    try:
+        return len(collection.insert_many(entries, ordered=False).inserted_ids)
+    except BulkWriteError as e:
+        return e.details.get('nInserted', 0)
@@ -0,0 +1,232 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from datetime import datetime, timedelta
+
+# Response cache for time windows that are already over. Their responses no longer change
+# unless a write touches them, so the serialized body is kept in an in-memory LRU (capped in
+# bytes) and, optionally, in a directory shared by all the workers and restarts.
+#
+# Invalidation works through versions stored in MongoDB (newspapers_meta.cache_versions): one
+# counter per scope/newspaper/day plus one per scope/newspaper ('*'). The versions of the days
+# of a window are part of the cache key, so a write only has to increment the version of its
+# day (or of the whole newspaper when the day is unknown) and every worker stops serving the
+# old entries at once.
+#
+# This file is copied in data_engine/ and context_manager/: each service is its own Docker
+# build context (COPY . of its folder), so they cannot import a shared module. Keep both
+# copies identical.
+
+MAX_BYTES = int(os.environ.get("RESPONSE_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+DISK_DIR = os.environ.get("RESPONSE_CACHE_DIR") or None
+DISK_MAX_BYTES = int(os.environ.get("RESPONSE_CACHE_DISK_MAX_BYTES", 1024 * 1024 * 1024))
+# Windows are cached once they ended this many seconds ago (feeds fetched just before the end
+# of a window may still be being stored)
+SETTLE_SECONDS = int(os.environ.get("RESPONSE_CACHE_SETTLE_SECONDS", 300))
+
+VERSIONS_DB = 'newspapers_meta'
+VERSIONS_COLLECTION = 'cache_versions'
+ALL_DAYS = '*'
+
+# Version scopes: real news (data_engine) and synthetic news of each database (context_manager)
+NEWS_SCOPE = 'news'
+LLM_SCOPE = 'newsLLM'
+
+CacheEntry = namedtuple('CacheEntry', ['etag', 'body', 'mimetype'])
+
+
+def is_settled(ts_end):
+    return ts_end is not None and ts_end < time.time() - SETTLE_SECONDS
+
+
+# Days (YYYY-MM-DD, local time like the windows) covered by [ts_start, ts_end]
+def window_days(ts_start, ts_end):
+    day = datetime.fromtimestamp(ts_start).date()
+    last = datetime.fromtimestamp(ts_end).date()
+    days = []
+    while day <= last:
+        days.append(day.isoformat())
+        day += timedelta(days=1)
+    return days
+
+
+def day_of(ts):
+    return datetime.fromtimestamp(int(ts)).date().isoformat()
+
+
+def version_key(scope, newspaper, day=ALL_DAYS):
+    return f"{scope}:{newspaper}:{day}"
+
+
+# Version keys a window depends on: the newspaper-wide key plus one per day
+def window_version_keys(scope, newspaper, ts_start, ts_end):
+    return [version_key(scope, newspaper)] + [version_key(scope, newspaper, day) for day in window_days(ts_start, ts_end)]
+
+
+# Version keys to increment after a write: the day of each date_stored, or the whole
+# newspaper when some written document has no date_stored
+def write_version_keys(scope, newspaper, dates_stored):
+    keys = set()
+    for date_stored in dates_stored:
+        try:
+            keys.add(version_key(scope, newspaper, day_of(date_stored)))
+        except (TypeError, ValueError, OverflowError, OSError):
+            keys.add(version_key(scope, newspaper))
+    return sorted(keys)
+
+
+def versions_tag(keys, documents):
+    versions = {doc['_id']: doc.get('version', 0) for doc in documents}
+    return ",".join(str(versions.get(key, 0)) for key in keys)
+
+
+# Version counters in MongoDB (blocking pymongo client)
+class CacheVersions:
+    def __init__(self, client):
+        self.collection = client[VERSIONS_DB][VERSIONS_COLLECTION]
+
+    # Cache key suffix with the current versions of `keys`
+    def tag(self, keys):
+        return versions_tag(keys, self.collection.find({'_id': {'$in': keys}}))
+
+    def bump(self, keys):
+        for key in keys:
+            self.collection.update_one({'_id': key}, {'$inc': {'version': 1}}, upsert=True)
+
+
+# Same counters through an async client (pymongo AsyncMongoClient)
+class AsyncCacheVersions:
+    def __init__(self, client):
+        self.collection = client[VERSIONS_DB][VERSIONS_COLLECTION]
+
+    async def tag(self, keys):
+        return versions_tag(keys, await self.collection.find({'_id': {'$in': keys}}).to_list(None))
+
+    async def bump(self, keys):
+        for key in keys:
+            await self.collection.update_one({'_id': key}, {'$inc': {'version': 1}}, upsert=True)
+
+
+class ResponseCache:
+    def __init__(self, max_bytes=MAX_BYTES, disk_dir=DISK_DIR, disk_max_bytes=DISK_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = disk_max_bytes
+        self._entries = OrderedDict()
+        self._size = 0
+        self._disk_writes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry
+
+        entry = self._read_disk(key)
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._remember(key, entry)
+        return entry
+
+    def put(self, key, body, mimetype):
+        entry = CacheEntry(hashlib.sha1(body).hexdigest(), body, mimetype)
+        with self._lock:
+            self._remember(key, entry)
+        self._write_disk(key, entry)
+        return entry
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+        if self.disk_dir:
+            for name in os.listdir(self.disk_dir):
+                if name.endswith('.cache'):
+                    try:
+                        os.remove(os.path.join(self.disk_dir, name))
+                    except OSError:
+                        pass
+
+    def summary(self):
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": self._size, "hits": self.hits, "misses": self.misses}
+
+    def _remember(self, key, entry):
+        if len(entry.body) > self.max_bytes:
+            return
+        previous = self._entries.pop(key, None)
+        if previous is not None:
+            self._size -= len(previous.body)
+        self._entries[key] = entry
+        self._size += len(entry.body)
+        while self._size > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._size -= len(evicted.body)
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.cache')
+
+    # Disk format: one JSON header line (key, etag, mimetype) followed by the body
+    def _read_disk(self, key):
+        if not self.disk_dir:
+            return None
+        try:
+            with open(self._disk_path(key), 'rb') as f:
+                header = json.loads(f.readline())
+                if header.get('key') != key:
+                    return None
+                return CacheEntry(header['etag'], f.read(), header['mimetype'])
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def _write_disk(self, key, entry):
+        if not self.disk_dir:
+            return
+        path = self._disk_path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(json.dumps({'key': key, 'etag': entry.etag, 'mimetype': entry.mimetype}).encode('utf-8') + b'\n')
+                f.write(entry.body)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"Error writing response cache entry: {e}")
+            return
+        with self._lock:
+            self._disk_writes += 1
+            prune = self._disk_writes % 100 == 0
+        if prune:
+            self._prune_disk()
+
+    # Removes the least recently written files while the directory exceeds disk_max_bytes
+    def _prune_disk(self):
+        try:
+            files = []
+            for name in os.listdir(self.disk_dir):
+                if name.endswith('.cache'):
+                    stat = os.stat(os.path.join(self.disk_dir, name))
+                    files.append((stat.st_mtime, stat.st_size, name))
+        except OSError:
+            return
+        total = sum(size for _, size, _ in files)
+        for _, size, name in sorted(files):
+            if total <= self.disk_max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.disk_dir, name))
+                total -= size
+            except OSError:
+                pass
@@ -2,4 +2,4 @@
 
 python3 engine.py --duration "*" --interval 1 &
 
-python3 api_data_engine.py
\ No newline at end of file
+gunicorn -c gunicorn.conf.py wsgi:app
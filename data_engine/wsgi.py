@@ -0,0 +1,4 @@
+# WSGI entry point for production serving: gunicorn -c gunicorn.conf.py wsgi:app
+from api_data_engine import create_app
+
+app = create_app()
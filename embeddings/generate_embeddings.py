@@ -1,8 +1,13 @@
 import chromadb
 import requests
-from chromadb.utils import embedding_functions
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from sentence_transformers import SentenceTransformer
-from datetime import datetime, timedelta
+from datetime import datetime
+import argparse
+import hashlib
+import json
+import os
 import re
 
 # Vector database ingestion script. Orchestrates the extraction of news articles from the data engine, 
@@ -11,6 +16,27 @@ import re
 
 IP_API= "localhost"
 API_PORT=5010
+MODEL_NAME = "intfloat/multilingual-e5-large"
+# New collections follow the e5 convention: passages are embedded as "passage: <text>" with
+# normalized embeddings (queries use "query: ", see text_generator/query_embedder.py).
+# Collections built before carry no metadata and keep being embedded from the raw text.
+EMBEDDING_FORMAT_KEY = "embedding_format"
+E5_FORMAT = "e5"
+E5_PASSAGE_PREFIX = "passage: "
+# Per-newspaper watermark (last date_stored already embedded) used by the incremental sync
+STATE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sync_state.json")
+# Collection with the news of every newspaper (--cross_newspaper). Its ids are
+# "<newspaper>:<_id>"; the Mongo _id is kept in the news_id metadata.
+CROSS_NEWSPAPER_COLLECTION = "real_news_data_all"
+# Timeouts (connect, read) for the data engine calls
+HTTP_TIMEOUT = (5, 60)
+
+# Keep-alive session reused by every call to the data engine, with retry/backoff on transient errors
+session = requests.Session()
+session.mount("http://", HTTPAdapter(
+    pool_maxsize=4,
+    max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=(502, 503, 504), allowed_methods=frozenset(["GET"]), raise_on_status=False),
+))
 
 # Text sanitization utility.
 def remove_html(text):
@@ -22,68 +48,229 @@ def remove_html(text):
     return clean_text
 
 
-# Retrieves the set of news articles for a specific source and time window
-def read_newspaper_news(newspaper, date, start_hour, start_minute, end_hour, end_minute):
-
-    params = "date="+date+"&shour="+start_hour+"&sminute="+start_minute+"&ehour="+end_hour+"&eminute="+end_minute
-    url = str("http://")+IP_API+":"+str(API_PORT)+"/news/"+newspaper+"?"
-    try:
-        response = requests.get(url, params=params)
+# Streams the news of one newspaper stored between start and end (dd-mm-yyyy[ HH:MM]) from the
+# NDJSON /news/range endpoint of the data engine, in (date_stored, _id) order: one request for
+# the whole window instead of one per day. A failed or interrupted stream raises
+# requests.exceptions.RequestException (or ValueError for a cut line).
+def read_range_news(newspaper, start, end):
+    url = str("http://")+IP_API+":"+str(API_PORT)+"/news/range"
+    params = {"start": start, "end": end, "newspapers": newspaper}
+    with session.get(url, params=params, timeout=HTTP_TIMEOUT, stream=True) as response:
         response.raise_for_status()  # Raises an error if HTTP code is 4xx or 5xx
-        return response.json()  # Returns the response in JSON format
-    except requests.exceptions.RequestException as e:
-        print(f"Error calling endpoint: {e}")
-        return None
+        for line in response.iter_lines():
+            if line:
+                yield json.loads(line)
 
 # Queries the data engine to obtain the catalogue of available newspaper sources 
 def read_newspapers():
     url = str("http://")+IP_API+":"+str(API_PORT)+"/newspapers"
     try:
-        response = requests.get(url)
+        response = session.get(url, timeout=HTTP_TIMEOUT)
         response.raise_for_status() 
         return response.json()  
     except requests.exceptions.RequestException as e:
         print(f"Error calling endpoint: {e}")
         return None
 
+# Hash of the cleaned text, used to detect repeated descriptions in O(1)
+def text_hash(text):
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+# Returns the newspaper collection, creating it in e5 format if it does not exist yet
+def get_news_collection(chroma_client, name):
+    try:
+        collection = chroma_client.get_collection(name=name, embedding_function=None)
+    except Exception:
+        return chroma_client.create_collection(name=name, metadata={EMBEDDING_FORMAT_KEY: E5_FORMAT}, embedding_function=None)
+    if not is_e5_collection(collection) and collection.count() == 0:
+        collection.modify(metadata={**(collection.metadata or {}), EMBEDDING_FORMAT_KEY: E5_FORMAT})
+    return collection
+
+
+def is_e5_collection(collection):
+    return (collection.metadata or {}).get(EMBEDDING_FORMAT_KEY) == E5_FORMAT
+
+
+# Encodes a batch of texts in one call (or through the multi-process pool if given)
+def encode_texts(model, texts, encode_batch_size, pool=None, e5=False):
+    if e5:
+        texts = [E5_PASSAGE_PREFIX + text for text in texts]
+    if pool is not None:
+        embeddings = model.encode_multi_process(texts, pool, batch_size=encode_batch_size, normalize_embeddings=e5)
+    else:
+        embeddings = model.encode(texts, batch_size=encode_batch_size, convert_to_numpy=True, normalize_embeddings=e5, show_progress_bar=False)
+    return embeddings.tolist()
+
+
+# Watermark persistence. The file is replaced atomically so an interrupted run keeps the previous state.
+def load_state(path=STATE_FILE):
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_state(state, path=STATE_FILE):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(state, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+# Metadata stored with each passage; the generators filter the retrieval on date_stored
+# (text_generator/retrieval_cache.py)
+def news_metadata(newspaper, news_item):
+    return {"date_stored": int(news_item["date_stored"]), "newspaper": str(newspaper), "news_id": str(news_item["_id"])}
+
+
+# Embeds a batch of (id, text, metadata) tuples and upserts it into the collection in chunks of
+# add_chunk. Ids are the Mongo _id of the news, so re-running over the same window is idempotent.
+# The same embeddings are upserted into `cross_collection` (if given) with newspaper-prefixed ids.
+def ingest_batch(collection, model, batch, encode_batch_size, add_chunk, pool=None, cross_collection=None):
+    ids = [item_id for item_id, _, _ in batch]
+    texts = [text for _, text, _ in batch]
+    metadatas = [metadata for _, _, metadata in batch]
+    embeddings = encode_texts(model, texts, encode_batch_size, pool, e5=is_e5_collection(collection))
+    for i in range(0, len(batch), add_chunk):
+        collection.upsert(
+            ids=ids[i:i + add_chunk],
+            documents=texts[i:i + add_chunk],
+            embeddings=embeddings[i:i + add_chunk],
+            metadatas=metadatas[i:i + add_chunk],
+        )
+        # Both collections are created in e5 format, except a legacy per-newspaper collection,
+        # whose embeddings are not copied
+        if cross_collection is not None and is_e5_collection(collection) == is_e5_collection(cross_collection):
+            cross_collection.upsert(
+                ids=[f"{m['newspaper']}:{m['news_id']}" for m in metadatas[i:i + add_chunk]],
+                documents=texts[i:i + add_chunk],
+                embeddings=embeddings[i:i + add_chunk],
+                metadatas=metadatas[i:i + add_chunk],
+            )
+
+
+# Adds the metadata to passages embedded with _id ids before it was stored, without embedding
+# them again. Ids that are not in the collection are ignored by Chroma, so collections built
+# by the first ingestion script (counter ids "0", "1", ...) are not updated: they have to be
+# dropped and embedded again.
+def update_metadata(collection, batch, add_chunk):
+    for i in range(0, len(batch), add_chunk):
+        chunk = batch[i:i + add_chunk]
+        collection.update(ids=[item_id for item_id, _, _ in chunk], metadatas=[metadata for _, _, metadata in chunk])
+
+
 if __name__ == "__main__":
-    print("Start - " + str(datetime.now()))
+    parser = argparse.ArgumentParser(description="Populate the Chroma vector database with the real news.")
     # Update these dates as needed
-    start_date = datetime.strptime("25-09-2025", "%d-%m-%Y")
-    end_date = datetime.strptime("25-10-2025", "%d-%m-%Y")
-   
+    parser.add_argument("--sdate", default="25-09-2025", help="Start date dd-mm-yyyy")
+    parser.add_argument("--edate", default="25-10-2025", help="End date dd-mm-yyyy")
+    parser.add_argument("--batch_size", type=int, default=1024, help="Texts collected before each encode call")
+    parser.add_argument("--encode_batch_size", type=int, default=32, help="Batch size of the SentenceTransformer forward pass")
+    parser.add_argument("--add_chunk", type=int, default=1000, help="Documents per Chroma add call")
+    parser.add_argument("--processes", type=int, default=0, help="CPU processes for the multi-process encode pool (0 = single process)")
+    parser.add_argument("--incremental", action="store_true", help="Only embed news stored after each newspaper's watermark, up to today")
+    parser.add_argument("--cross_newspaper", action="store_true", help=f"Also store every passage in the '{CROSS_NEWSPAPER_COLLECTION}' collection")
+    parser.add_argument("--metadata_only", action="store_true", help="Only add date_stored/newspaper/news_id metadata to passages already embedded with _id ids")
+    args = parser.parse_args()
+    # A metadata-only pass embeds nothing, so it must not move the incremental watermark
+    if args.metadata_only and args.incremental:
+        parser.error("--metadata_only cannot be combined with --incremental")
+
+    print("Start - " + str(datetime.now()))
+    start_date = datetime.strptime(args.sdate, "%d-%m-%Y")
+    end_date = datetime.strptime(args.edate, "%d-%m-%Y")
+    if args.incremental:
+        end_date = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    state = load_state()
 
     chroma_client = chromadb.HttpClient(host='localhost', port=8001)
 
-    # Initialization of the embedding function using 'intfloat/multilingual-e5-large'
-    embedding_fn = embedding_functions.SentenceTransformerEmbeddingFunction(
-        model_name="intfloat/multilingual-e5-large"
-    )
-    
-    for newspaper in read_newspapers().get('newspapers'):
-       
-        print(newspaper + " - " + str(datetime.now()), flush=True)
-        # Create or retrieve a distinct collection for each newspaper source
-        collection = chroma_client.get_or_create_collection(name="real_news_data_"+str(newspaper), embedding_function=embedding_fn)
-
-        count = 0
-        current_day = start_date
-        real_news = []
-        texts = []
-        while current_day <= end_date:
-            
-            print(current_day.strftime("%d-%m-%Y") + " --- " + str(datetime.now()), flush=True)          
-            real_news=(read_newspaper_news(newspaper, str(current_day.strftime("%d-%m-%Y")), "00", "00", "23", "00").get("items"))
-            print(len(real_news))
-
-            for news_item in real_news:
-                # Insert news into Chroma
-                if news_item["description"] != None and news_item["description"] not in texts:
-
-                    news_item["description"] = remove_html(news_item["description"])
-                    texts.append(news_item["description"])
-                    collection.add(documents= news_item["description"], ids=str(count))
+    # The 'intfloat/multilingual-e5-large' model is loaded once and used to encode whole batches.
+    # Embeddings are passed explicitly to Chroma, so the collections need no embedding function here.
+    model = None if args.metadata_only else SentenceTransformer(MODEL_NAME)
+    pool = model.start_multi_process_pool(["cpu"] * args.processes) if model is not None and args.processes > 1 else None
+    cross_collection = get_news_collection(chroma_client, CROSS_NEWSPAPER_COLLECTION) if args.cross_newspaper else None
+
+    # Embeds a batch (or, with --metadata_only, only updates its metadata)
+    def flush(collection, batch):
+        if args.metadata_only:
+            update_metadata(collection, batch, args.add_chunk)
+        else:
+            ingest_batch(collection, model, batch, args.encode_batch_size, args.add_chunk, pool, cross_collection)
+
+    try:
+        for newspaper in read_newspapers().get('newspapers'):
+
+            print(newspaper + " - " + str(datetime.now()), flush=True)
+            # Create or retrieve a distinct collection for each newspaper source
+            collection = get_news_collection(chroma_client, "real_news_data_"+str(newspaper))
+
+            # In incremental mode the sync restarts from the minute of the watermark and skips
+            # everything stored up to it
+            watermark = int(state.get(newspaper, 0)) if args.incremental else 0
+            range_start = start_date
+            if watermark:
+                range_start = datetime.fromtimestamp(watermark)
+            max_date_stored = watermark
+
+            count = 0
+            seen_hashes = set()
+            batch = []
+            failed = False
+            current_day = None
+            try:
+                for news_item in read_range_news(newspaper, range_start.strftime("%d-%m-%Y %H:%M"), end_date.strftime("%d-%m-%Y")):
+                    date_stored = int(news_item["date_stored"])
+                    day = datetime.fromtimestamp(date_stored).strftime("%d-%m-%Y")
+                    if day != current_day:
+                        # Incremental runs commit each finished day (the stream is ordered by
+                        # date_stored), so an interrupted sync resumes from there
+                        if args.incremental and current_day is not None:
+                            if batch:
+                                flush(collection, batch)
+                                batch = []
+                            state[newspaper] = max_date_stored
+                            save_state(state)
+                        current_day = day
+                        print(day + " --- " + str(datetime.now()), flush=True)
+
+                    if date_stored <= watermark:
+                        continue
+                    max_date_stored = max(max_date_stored, date_stored)
+                    if news_item["description"] is None:
+                        continue
+                    description = remove_html(news_item["description"])
+                    digest = text_hash(description)
+                    if not description or digest in seen_hashes:
+                        continue
+                    seen_hashes.add(digest)
+                    batch.append((str(news_item["_id"]), description, news_metadata(newspaper, news_item)))
                     count = count + 1
-                    
-                    
-            current_day += timedelta(days=1)
\ No newline at end of file
+
+                    if len(batch) >= args.batch_size:
+                        flush(collection, batch)
+                        batch = []
+            except (requests.exceptions.RequestException, ValueError) as e:
+                # A failed or cut stream is not the end of the news: the sync of the newspaper
+                # stops here and the watermark is not moved past the last complete day, so the
+                # next run reads the rest again
+                print(f"ERROR: sync of {newspaper} stopped ({e}), the watermark stays at its last complete day", flush=True)
+                failed = True
+
+            if batch:
+                flush(collection, batch)
+            # A window run only moves the watermark when it starts at or before it (or there is
+            # none yet); otherwise the news between the watermark and the window would never be
+            # synced by --incremental
+            stored_watermark = int(state.get(newspaper, 0))
+            covers_watermark = not stored_watermark or start_date.timestamp() <= stored_watermark
+            # A metadata-only pass embeds nothing, so it never moves the watermark; neither does
+            # a sync stopped by a failed read (its later days were not read)
+            if not failed and not args.metadata_only and max_date_stored > stored_watermark and (args.incremental or covers_watermark):
+                state[newspaper] = max_date_stored
+                save_state(state)
+            print(f"{newspaper}: {count} documents - " + str(datetime.now()), flush=True)
+    finally:
+        if pool is not None:
+            SentenceTransformer.stop_multi_process_pool(pool)
@@ -0,0 +1,121 @@
+import argparse
+import itertools
+import sys
+import time
+from datetime import datetime
+
+import chromadb
+import requests
+
+import http_sessions
+import hilos_news_generator as generator
+import ollama_execution
+from context_builder import format_context
+from generation_scheduler import GenerationScheduler, batch_by_model, count_model_switches
+from ollama_execution import GenerationMetrics, OllamaRouter, parse_endpoints
+from query_embedder import QueryEmbedder
+from retrieval_cache import RetrievalCache
+
+# Compares the original job order of hilos_news_generator (every item goes through its six
+# models in turn) with the model-affinity order of batch_by_model on the same news items.
+# For each order it reports the model switches of the sequence, the model loads reported
+# by Ollama, and the generated items/hour. Nothing is stored.
+#
+#   python benchmark_model_batching.py --model QWEN_7B_ --newspaper elpais --date 01-10-2025 --limit 20
+
+FEATURES = [3, 2, 1]
+
+
+# Job list of the first `limit` news items of a newspaper/day, in the generator order
+def load_jobs(args):
+    generator.API_IP = args.api_ip
+    generator.REAL_API_PORT = args.api_port
+    chroma_client = chromadb.HttpClient(host=args.chroma_ip, port=args.chroma_port)
+    date = datetime.strptime(args.date, "%d-%m-%Y")
+    jobs = generator.generate_jobs([args.newspaper], chroma_client, QueryEmbedder(), date, date, 0, 23, args.model, FEATURES, RetrievalCache(), 0, shared_base=args.shared_base, retrieval_options={"time_filter": True})
+    return list(itertools.islice(jobs, args.limit * 2 * len(FEATURES)))
+
+
+# Asks every endpoint to unload the models, so each order starts with the same (cold) server
+def unload_models(router, models):
+    for endpoint in router.endpoints:
+        for model in models:
+            url = f"http://{endpoint.ip}:{endpoint.port}/api/generate"
+            try:
+                http_sessions.post(http_sessions.OLLAMA, url, json={"model": model, "keep_alive": 0})
+            except requests.exceptions.RequestException as e:
+                print(f"Could not unload {model} from {endpoint.name}: {e}")
+
+
+def run_job(job, router):
+    news_item = job.news_item
+    request_options = dict(options=job.options, keep_alive=ollama_execution.KEEP_ALIVE) if job.options else {}
+    if job.rag:
+        result, job.served_by = router.generate(ollama_execution.exec_ollama_rag, job.model, "source_title: " + str(news_item["headline"]), "descripcion: " + str(news_item["description"]), format_context(job.context), job.model, **request_options)
+    else:
+        result, job.served_by = router.generate(ollama_execution.exec_ollama, job.model, "source_title: " + str(news_item["headline"]), "source_description: " + str(news_item["description"]), job.model, **request_options)
+    return result.ok
+
+
+# Runs one job order against Ollama and returns its row of the report
+def run_order(name, jobs, args):
+    router = OllamaRouter(parse_endpoints(args.ollama_endpoints, args.max_inflight))
+    router.refresh()
+    unload_models(router, sorted({job.model for job in jobs}))
+    ollama_execution.metrics = GenerationMetrics()
+
+    start = time.monotonic()
+    GenerationScheduler(max_inflight={generator.OLLAMA_POOL: router.capacity}).run(jobs, lambda job: run_job(job, router))
+    elapsed = time.monotonic() - start
+
+    items = len({job.news_item["_id"] for job in jobs})
+    metrics = ollama_execution.metrics
+    return {
+        "order": name,
+        "jobs": len(jobs),
+        "sequence_switches": count_model_switches(job.model for job in jobs),
+        "endpoint_switches": sum(endpoint.model_switches for endpoint in router.endpoints),
+        "model_loads": metrics.model_loads,
+        "load_sec": metrics.load_duration_sec,
+        "elapsed_sec": elapsed,
+        "items_per_hour": items / elapsed * 3600 if elapsed > 0 else 0.0,
+    }
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Comparar el orden original de generación con el agrupado por modelo.")
+    parser.add_argument('--model', required=True, type=str, help='Prefijo del nombre del modelo (ej: QWEN_7B_)')
+    parser.add_argument('--newspaper', required=True, type=str, help='Periódico de las noticias de prueba')
+    parser.add_argument('--date', required=True, type=str, help='Día de las noticias de prueba dd-mm-yyyy')
+    parser.add_argument('--limit', type=int, default=20, help='Noticias a generar con cada orden')
+    parser.add_argument('--model_batch', type=int, default=24, help='Trabajos seguidos del mismo modelo en el orden agrupado')
+    parser.add_argument('--shared_base', action='store_true', help='Usar un modelo base por familia (ver hilos_news_generator)')
+    parser.add_argument('--dry_run', action='store_true', help='Solo contar los cambios de modelo de cada orden, sin llamar a Ollama')
+    parser.add_argument('--api_ip', default="localhost", help="IP API Backend de periódicos")
+    parser.add_argument('--api_port', type=int, default=5010, help="Puerto API Backend")
+    parser.add_argument('--chroma_ip', default="localhost", help="IP ChromaDB")
+    parser.add_argument('--chroma_port', type=int, default=8001, help="Puerto ChromaDB")
+    parser.add_argument('--ollama_endpoints', default="localhost:11434", help="Servidores Ollama ip:puerto separados por comas")
+    parser.add_argument('--max_inflight', type=int, default=1, help="Peticiones simultáneas por servidor (OLLAMA_NUM_PARALLEL)")
+    args = parser.parse_args()
+
+    jobs = load_jobs(args)
+    if not jobs:
+        print("No hay noticias para el periódico y la fecha indicados.")
+        sys.exit(1)
+
+    orders = [("original", jobs), (f"batched({args.model_batch})", list(batch_by_model(jobs, args.model_batch)))]
+
+    print(f"{len(jobs)} jobs, {len({job.news_item['_id'] for job in jobs})} news items, {len({job.model for job in jobs})} models")
+    if args.dry_run:
+        for name, order in orders:
+            print(f"{name:>14}: {count_model_switches(job.model for job in order)} model switches")
+        sys.exit(0)
+
+    rows = [run_order(name, order, args) for name, order in orders]
+    print("------------------------------------------------")
+    print(f"{'order':>14} {'jobs':>6} {'switches':>9} {'endpoint':>9} {'loads':>6} {'load s':>8} {'elapsed s':>10} {'items/h':>9}")
+    for row in rows:
+        print(f"{row['order']:>14} {row['jobs']:>6} {row['sequence_switches']:>9} {row['endpoint_switches']:>9} {row['model_loads']:>6} "
+              f"{row['load_sec']:>8.1f} {row['elapsed_sec']:>10.1f} {row['items_per_hour']:>9.1f}")
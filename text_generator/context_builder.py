@@ -0,0 +1,113 @@
+import os
+import re
+
+try:
+    from transformers import AutoTokenizer
+except ImportError:
+    AutoTokenizer = None
+
+# Builds the RAG context of a prompt from the passages retrieved from Chroma. Passages that
+# repeat (after normalization) and the one identical to the source description are dropped,
+# the rest are kept in retrieval order until the token budget is spent (the last one may be
+# cut), and the prompt gets them as a numbered list instead of the repr of Chroma's nested
+# results["documents"] list.
+#
+# Tokens are counted with the Hugging Face tokenizer of the model when `transformers` is
+# installed and the tokenizer can be loaded; otherwise they are estimated as 4 characters
+# per token, which errs on the long side for Spanish news text.
+
+# Token budget of the context in the prompt. The RAG models run with num_ctx 4096, which also
+# has to hold the system prompt, the headline and the answer (num_predict 256).
+CONTEXT_TOKEN_BUDGET = int(os.environ.get("CONTEXT_TOKEN_BUDGET", 1500))
+# A passage is only cut to fit the remaining budget if at least this many tokens are left
+MIN_PASSAGE_TOKENS = 32
+CHARS_PER_TOKEN = 4
+
+# Hugging Face tokenizers of the model families (prefix of the Ollama model name)
+TOKENIZERS = {
+    "QWEN_7B_": "Qwen/Qwen2.5-7B-Instruct",
+    "GEMA_9B_": "google/gemma-2-9b-it",
+}
+
+
+def normalize_passage(text):
+    text = re.sub(r'<[^>]+>', '', text)
+    return re.sub(r'\s+', ' ', text).strip()
+
+
+# Key used to compare passages: case, punctuation and spacing are ignored
+def passage_key(text):
+    return re.sub(r'\W+', ' ', normalize_passage(text).lower()).strip()
+
+
+# Passages of one Chroma result: the inner list of results["documents"] ([[doc, ...]] for
+# one query) or a plain list of documents
+def result_passages(context):
+    if context and isinstance(context[0], list):
+        context = context[0]
+    return [passage for passage in (context or []) if isinstance(passage, str)]
+
+
+# Numbered, one passage per line
+def format_context(passages):
+    return "\n".join(f"[{i}] {passage}" for i, passage in enumerate(passages, 1))
+
+
+class ContextBuilder:
+    def __init__(self, max_tokens=CONTEXT_TOKEN_BUDGET, tokenizer_name=None):
+        self.max_tokens = max_tokens
+        self.tokenizer = self.load_tokenizer(tokenizer_name)
+
+    @staticmethod
+    def load_tokenizer(tokenizer_name):
+        if not tokenizer_name or AutoTokenizer is None:
+            return None
+        try:
+            return AutoTokenizer.from_pretrained(tokenizer_name)
+        except Exception as e:
+            print(f"Tokenizer {tokenizer_name} not available ({e}), estimating {CHARS_PER_TOKEN} characters per token")
+            return None
+
+    @classmethod
+    def for_model(cls, model_prefix, max_tokens=CONTEXT_TOKEN_BUDGET):
+        return cls(max_tokens, TOKENIZERS.get(model_prefix))
+
+    def count_tokens(self, text):
+        if self.tokenizer is not None:
+            return len(self.tokenizer.encode(text, add_special_tokens=False))
+        return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+    # First `max_tokens` tokens of a passage, cut at a word boundary
+    def truncate(self, text, max_tokens):
+        if self.tokenizer is not None:
+            ids = self.tokenizer.encode(text, add_special_tokens=False)[:max_tokens]
+            cut = self.tokenizer.decode(ids)
+        else:
+            cut = text[:max_tokens * CHARS_PER_TOKEN]
+        if len(cut) < len(text) and " " in cut:
+            cut = cut.rsplit(" ", 1)[0]
+        return cut.rstrip(" ,;:") + "..."
+
+    # Passages to put in the prompt for a news item, in retrieval order
+    def select(self, context, source_description=""):
+        source_key = passage_key(source_description or "")
+        seen = {source_key} if source_key else set()
+        selected = []
+        remaining = self.max_tokens
+
+        for passage in result_passages(context):
+            passage = normalize_passage(passage)
+            key = passage_key(passage)
+            if not key or key in seen:
+                continue
+            seen.add(key)
+
+            # The numbering and the line break take a couple of tokens per passage
+            tokens = self.count_tokens(passage) + 2
+            if tokens > remaining:
+                if remaining - 2 >= MIN_PASSAGE_TOKENS:
+                    selected.append(self.truncate(passage, remaining - 2))
+                break
+            selected.append(passage)
+            remaining -= tokens
+        return selected
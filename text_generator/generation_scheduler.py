@@ -0,0 +1,173 @@
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+
+# Asynchronous generation scheduler. Consumes a flat stream of generation jobs
+# (newspaper x day x item x temperature x RAG/NO-RAG) and dispatches them to the
+# Ollama backends with a bounded number of in-flight requests per backend, so the
+# throughput depends on the model capacity and not on how the work is split.
+
+
+# Unit of work: one generation request for one news item, temperature and RAG mode.
+# `backend` selects the scheduler queue; the worker may set `served_by` to the concrete
+# endpoint that answered (e.g. when a router picks it), which is used for the statistics.
+@dataclass
+class GenerationJob:
+    newspaper: str
+    id_feature: int
+    rag: int
+    model: str
+    backend: str
+    news_item: dict
+    context: list = field(default_factory=list)
+    served_by: str = None
+    # Per-request Ollama options (shared-base mode), None to use the Modelfile parameters
+    options: dict = None
+
+
+# Model-affinity ordering of a job stream. Jobs are held in one queue per model name and
+# released as a batch of `max_batch` jobs of the same model as soon as a queue fills up, so a
+# server running one model at a time (OLLAMA_NUM_PARALLEL=1) loads each model once per batch
+# instead of once or twice per item. At most max_batch - 1 jobs per model are held back;
+# the remaining queues are released at the end of the stream, starting with the model of
+# the last batch. Jobs of the same model keep their original order.
+def batch_by_model(jobs, max_batch):
+    if max_batch <= 1:
+        yield from jobs
+        return
+    pending = OrderedDict()
+    current = None
+    for job in jobs:
+        queue = pending.setdefault(job.model, [])
+        queue.append(job)
+        if len(queue) >= max_batch:
+            current = job.model
+            yield from pending.pop(current)
+    if current in pending:
+        yield from pending.pop(current)
+    for queue in pending.values():
+        yield from queue
+
+
+# Number of model changes in a sequence of model names (each one is a reload on a
+# server that keeps a single model loaded)
+def count_model_switches(models):
+    switches = 0
+    previous = None
+    for model in models:
+        if previous is not None and model != previous:
+            switches += 1
+        previous = model
+    return switches
+
+
+# Per-backend throughput counters (thread-safe, updated from the worker threads).
+class BackendStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._started = {}
+        self._finished = {}
+        self._jobs = {}
+        self._errors = {}
+
+    def record(self, backend, ok, pool=None):
+        now = time.monotonic()
+        with self._lock:
+            self._started.setdefault(backend, self._started.get(pool, now))
+            self._finished[backend] = now
+            self._jobs[backend] = self._jobs.get(backend, 0) + 1
+            if not ok:
+                self._errors[backend] = self._errors.get(backend, 0) + 1
+
+    def start(self, backend):
+        with self._lock:
+            self._started.setdefault(backend, time.monotonic())
+
+    def summary(self):
+        with self._lock:
+            rows = []
+            for backend in sorted(self._jobs):
+                elapsed = self._finished[backend] - self._started[backend]
+                jobs = self._jobs[backend]
+                rows.append({
+                    "backend": backend,
+                    "jobs": jobs,
+                    "errors": self._errors.get(backend, 0),
+                    "elapsed_sec": elapsed,
+                    "jobs_per_sec": jobs / elapsed if elapsed > 0 else 0.0,
+                })
+            return rows
+
+
+# Runs a job stream with at most `max_inflight` concurrent jobs per backend
+# (an int for every backend, or a dict backend -> limit). `jobs` is a (blocking)
+# iterable, consumed lazily in its own thread; `worker` is a blocking callable
+# executed in a per-backend thread pool that returns True when the job succeeded.
+class GenerationScheduler:
+    def __init__(self, max_inflight=2, queue_size=None):
+        limits = max_inflight.values() if isinstance(max_inflight, dict) else [max_inflight]
+        if min(limits) < 1:
+            raise ValueError("max_inflight must be >= 1")
+        self.max_inflight = max_inflight
+        self.queue_size = queue_size
+        self.stats = BackendStats()
+
+    def _limit(self, backend):
+        if isinstance(self.max_inflight, dict):
+            return self.max_inflight.get(backend, 1)
+        return self.max_inflight
+
+    def run(self, jobs, worker):
+        asyncio.run(self._run(jobs, worker))
+        return self.stats.summary()
+
+    async def _run(self, jobs, worker):
+        loop = asyncio.get_running_loop()
+        producer_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="jobs")
+        executors = {}
+        queues = {}
+        consumers = []
+
+        async def consume(backend, queue):
+            while True:
+                job = await queue.get()
+                if job is None:
+                    queue.task_done()
+                    return
+                try:
+                    ok = await loop.run_in_executor(executors[backend], worker, job)
+                except Exception as e:
+                    print(f"[{backend}] Job error ({job.newspaper}, T{job.id_feature}, RAG={job.rag}): {e}")
+                    ok = False
+                self.stats.record(job.served_by or backend, bool(ok), pool=backend)
+                queue.task_done()
+
+        def open_backend(backend):
+            limit = self._limit(backend)
+            executors[backend] = ThreadPoolExecutor(max_workers=limit, thread_name_prefix=backend)
+            queues[backend] = asyncio.Queue(maxsize=self.queue_size or limit * 4)
+            self.stats.start(backend)
+            for _ in range(limit):
+                consumers.append(asyncio.create_task(consume(backend, queues[backend])))
+
+        iterator = iter(jobs)
+        sentinel = object()
+        try:
+            while True:
+                job = await loop.run_in_executor(producer_executor, next, iterator, sentinel)
+                if job is sentinel:
+                    break
+                if job.backend not in queues:
+                    open_backend(job.backend)
+                await queues[job.backend].put(job)
+        finally:
+            for backend, queue in queues.items():
+                for _ in range(self._limit(backend)):
+                    await queue.put(None)
+            await asyncio.gather(*consumers)
+            producer_executor.shutdown(wait=True)
+            for executor in executors.values():
+                executor.shutdown(wait=True)
@@ -6,12 +6,18 @@ from ollama import chat
 from ollama import Client
 import re
 import chromadb
-from chromadb.utils import embedding_functions
 import threading
 import argparse
 import sys
 
-from ollama_execution import exec_ollama, exec_ollama_rag
+import http_sessions
+from ollama_execution import exec_ollama, exec_ollama_rag, OllamaRouter, parse_endpoints, metrics as ollama_metrics, model_name, variant_options, KEEP_ALIVE
+from context_builder import CONTEXT_TOKEN_BUDGET, ContextBuilder, format_context
+from generation_scheduler import GenerationJob, GenerationScheduler, batch_by_model
+from llm_news_buffer import LLMNewsBuffer
+from retrieval_cache import CROSS_NEWSPAPER_COLLECTION, RetrievalCache
+from query_embedder import QueryEmbedder
+from run_manifest import RunManifest
 
 # --- Configuration Constants (Defaults) ---
 API_IP = "localhost"
@@ -23,11 +29,17 @@ OLLAMA_PORT = 11434
 LLM_API_IP = "localhost"
 LLM_API_PORT = 6002
 
+# Pool key used by the scheduler; the router picks the concrete endpoint per request
+OLLAMA_POOL = "ollama"
+
 # --- Global Variables & Locks ---
 data_lock = threading.Lock() 
 error_count = 0
 num_generated_news_NO_RAG = 0
 num_generated_news_RAG = 0
+num_insert_errors = 0
+num_skipped = 0
+num_cluster_skipped = 0
 
 # --- Helper Functions ---
 def remove_html(text):
@@ -38,7 +50,7 @@ def remove_html(text):
 def get_newspapers():
     url = str("http://") + API_IP + ":" + str(REAL_API_PORT) + "/newspapers"
     try:
-        response = requests.get(url)
+        response = http_sessions.get(http_sessions.DATA_ENGINE, url)
         response.raise_for_status()
         return response.json()
     except requests.exceptions.RequestException as e:
@@ -49,7 +61,7 @@ def read_newspaper_news(newspaper, date, shour, sminute, ehour, eminute):
     params = "date=" + date + "&shour=" + shour + "&sminute=" + sminute + "&ehour=" + ehour + "&eminute=" + eminute
     url = str("http://") + API_IP + ":" + str(REAL_API_PORT) + "/news/" + newspaper + "?"
     try:
-        response = requests.get(url, params=params)
+        response = http_sessions.get(http_sessions.DATA_ENGINE, url, params=params)
         response.raise_for_status()
         return response.json()
     except requests.exceptions.RequestException as e:
@@ -61,111 +73,168 @@ def update_news(newspaper, news_id, tag, tag_value):
     headers = {"Content-Type": "application/json"}
     data = {tag: tag_value}
     try:
-        response = requests.put(url, json=data, headers=headers)
+        response = http_sessions.put(http_sessions.DATA_ENGINE, url, json=data, headers=headers)
         response.raise_for_status()
         return response.json()
     except requests.exceptions.RequestException as e:
         print(f"Error updating entry: {e}")
         return None
 
-# --- Worker Function (Thread) ---
-def process_feature_thread(newspaper, id_feature, start_date, end_date, start_hour, end_hour, collection, id_llm, modelo):
+# --- Retrieval ---
+# retrieval_options: {"time_filter": only news stored before the headline,
+#                     "max_age": seconds searched back from the headline (None = no limit),
+#                     "max_distance": distance cut-off of the passages (None = no cut-off),
+#                     "cross_newspaper": search the collection of every newspaper}
+def retrieval_collection_name(newspaper, retrieval_options=None):
+    if (retrieval_options or {}).get("cross_newspaper"):
+        return CROSS_NEWSPAPER_COLLECTION
+    return "real_news_data_" + str(newspaper)
+
+# Filter arguments of RetrievalCache.query_batch for a list of news items
+def retrieval_query_args(news_items, retrieval_options=None):
+    retrieval_options = retrieval_options or {}
+    before = [int(news_item["date_stored"]) for news_item in news_items] if retrieval_options.get("time_filter") else None
+    return {"before": before, "max_age": retrieval_options.get("max_age"), "max_distance": retrieval_options.get("max_distance")}
+
+# --- Job Stream ---
+# Flattens newspaper x day x item x temperature x RAG/NO-RAG into a single stream of
+# generation jobs. The RAG context of a whole newspaper/day is retrieved with one batched
+# embedding + Chroma query before its jobs are emitted. With a manifest, generations that
+# are already stored are skipped; with one_per_cluster, only the first news item of each
+# near-duplicate cluster (cluster_id tagged by the data engine) is generated.
+# The jobs of an item are emitted family by family (NO_RAG, then RAG), so the temperature
+# variants of the same prompt reach Ollama back-to-back. With shared_base they run on the
+# T1 model of the family with per-request options (see ollama_execution.model_name).
+# RAG jobs carry the passages chosen by `context_builder` (see context_builder.py).
+# `retrieval_options` configures the search (see retrieval_query_args).
+def generate_jobs(newspapers, chroma_client, query_embedder, start_date, end_date, start_hour, end_hour, modelo, features, retrieval_cache, id_llm, manifest=None, one_per_cluster=False, shared_base=False, context_builder=None, retrieval_options=None):
+    global num_skipped
+    global num_cluster_skipped
+    backend = OLLAMA_POOL
+    delta_days = (end_date - start_date).days
+    seen_clusters = set()
+    context_builder = context_builder or ContextBuilder()
+
+    for newspaper in newspapers:
+        collection = chroma_client.get_or_create_collection(name=retrieval_collection_name(newspaper, retrieval_options), embedding_function=None)
+
+        for i in range(delta_days + 1):
+            current_date = start_date + timedelta(days=i)
+            day = current_date.day
+            month = current_date.month
+            year = current_date.year
+
+            news_data = read_newspaper_news(newspaper, str(day) + "-" + str(month) + "-" + str(year), str(start_hour), "00", str(end_hour), "00")
+
+            if news_data is None or "items" not in news_data:
+                continue
+
+            news_items = [news_item for news_item in news_data["items"] if news_item.get("description")]
+
+            if one_per_cluster:
+                unique_items = []
+                for news_item in news_items:
+                    cluster_id = news_item.get("cluster_id")
+                    if cluster_id and cluster_id in seen_clusters:
+                        num_cluster_skipped += 1
+                        continue
+                    if cluster_id:
+                        seen_clusters.add(cluster_id)
+                    unique_items.append(news_item)
+                news_items = unique_items
+
+            # (id_feature, RAG) pairs still pending for each item
+            pending = []
+            for news_item in news_items:
+                todo = [(id_feature, rag) for rag in (0, 1) for id_feature in features]
+                if manifest is not None:
+                    todo = [(f, r) for f, r in todo if not manifest.is_done(news_item["_id"], f, id_llm, r)]
+                    num_skipped += 2 * len(features) - len(todo)
+                pending.append(todo)
+            news_items, pending = [n for n, t in zip(news_items, pending) if t], [t for t in pending if t]
+            if not news_items:
+                continue
+
+            try:
+                contexts = retrieval_cache.query_batch(collection, [news_item["headline"] for news_item in news_items], query_embedder, n_results=10, **retrieval_query_args(news_items, retrieval_options))
+            except Exception as e:
+                print(f"Error querying ChromaDB: {e}")
+                contexts = [[""]] * len(news_items)
+
+            for news_item, context, todo in zip(news_items, contexts, pending):
+                news_item["description"] = remove_html(news_item["description"])
+                if any(rag for _, rag in todo):
+                    context = context_builder.select(context, news_item["description"])
+
+                for id_feature, rag in todo:
+                    options = variant_options(id_feature) if shared_base else None
+                    model = model_name(modelo, rag, id_feature, shared_base)
+                    if rag:
+                        yield GenerationJob(newspaper, id_feature, 1, model, backend, news_item, context, options=options)
+                    else:
+                        yield GenerationJob(newspaper, id_feature, 0, model, backend, news_item, options=options)
+
+# Called after each bulk flush: counts the documents rejected by the storage API and
+# records the stored ones in the run manifest.
+def on_batch_stored(newspaper, documents, results, manifest):
+    global num_insert_errors
+    failed = len(documents) if results is None else sum(1 for r in results if "error" in r)
+    with data_lock:
+        num_insert_errors += failed
+    manifest.record(documents, results)
+
+# --- Worker Function ---
+# Runs one generation job against Ollama and buffers the result for storage. Returns True on success.
+def run_job(job, id_llm, router, buffer):
     global error_count
     global num_generated_news_NO_RAG
     global num_generated_news_RAG
 
-    model_NO_RAG = modelo + "LLM_resumen_NO_RAG_T"+str(id_feature)
-    model_RAG = modelo + "LLM_resumen_RAG_T"+str(id_feature)
+    news_item = job.news_item
+    label = "RAG" if job.rag else "NO-RAG"
 
-    endpoint_url = "http://" + str(LLM_API_IP) + ":" + str(LLM_API_PORT) + "/newsLLM/" + newspaper
+    print(f"[F{job.id_feature}] {label} Processing: {news_item['headline'][:30]}...")
 
-    delta_days = (end_date - start_date).days
-    
-    for i in range(delta_days + 1):
-        current_date = start_date + timedelta(days=i)
-        day = current_date.day
-        month = current_date.month
-        year = current_date.year
-    
-        news_data = read_newspaper_news(newspaper, str(day) + "-" + str(month) + "-" + str(year), str(start_hour), "00", str(end_hour), "00")
-        
-        if news_data is not None and "items" in news_data:
-            for news_item in news_data["items"]:
-                
-                document_NO_RAG = dict()
-                document_RAG = dict()
-
-                if news_item.get("description"):
-                    query_text = news_item["headline"]
-                    try:
-                        results = collection.query(
-                                query_texts=[query_text],
-                                n_results=10 
-                            )
-                        context = results["documents"]
-                    except Exception as e:
-                        print(f"Error querying ChromaDB: {e}")
-                        context = [""]
-
-                    news_item["description"] = remove_html(news_item["description"])
-                    
-                    try:
-                        print(f"[Thread-F{id_feature}] Processing: {news_item['headline'][:30]}...")
-                        
-                        # --- NO RAG Generation ---
-                        synthetic_desc_no_rag = exec_ollama(None, OLLAMA_IP, OLLAMA_PORT, "source_title: " + str(news_item["headline"]), "source_description: " + str(news_item["description"]), model_NO_RAG).get("synthetic_description", "N/A")
-
-                        document_NO_RAG = {
-                        "RAG": 0,
-                        "id_news": news_item["_id"],
-                        "timestamp_llm": int(datetime.now().timestamp()),
-                        "id_feature": id_feature,
-                        "id_llm": id_llm,
-                        "synthetic_description": synthetic_desc_no_rag,
-                        }
-
-                        # --- RAG Generation ---
-                        synthetic_desc_rag = exec_ollama_rag(None, OLLAMA_IP, OLLAMA_PORT, "source_title: " + str(news_item["headline"]), "descripcion: " + str(news_item["description"]), context, model_RAG).get("synthetic_description", "N/A")
-
-                        document_RAG = {
-                        "RAG": 1,
-                        "id_news": news_item["_id"],
-                        "timestamp_llm": int(datetime.now().timestamp()),
-                        "id_feature": id_feature,
-                        "id_llm": id_llm,
-                        "context": context[0] if context else "",
-                        "synthetic_description": synthetic_desc_rag,
-                        }
-                
-                        # --- Send to API ---
-                        try:
-                            # Enviar RAG
-                            if document_RAG:
-                                response = requests.post(endpoint_url, json=document_RAG)
-                                with data_lock:
-                                    num_generated_news_RAG += 1
-                                if response.status_code == 201:
-                                    print(f"[Thread-F{id_feature}] RAG Inserted OK")
-                                else:
-                                    print(f"Error RAG API: {response.status_code}")
-
-                            # Enviar NO RAG
-                            if document_NO_RAG:
-                                response = requests.post(endpoint_url, json=document_NO_RAG)
-                                with data_lock:
-                                    num_generated_news_NO_RAG += 1
-                                if response.status_code == 201:
-                                    print(f"[Thread-F{id_feature}] NO-RAG Inserted OK")
-                                else:
-                                    print(f"Error NO-RAG API: {response.status_code}")
-
-                        except requests.exceptions.RequestException as e:
-                            print("Error connecting to Storage API:", e)
-                        
-                    except Exception as e:
-                        print("Error processing news with Ollama:", e)
-                        with data_lock:
-                            error_count += 1
+    # Shared-base jobs carry their sampling options and keep the base model loaded
+    request_options = dict(options=job.options, keep_alive=KEEP_ALIVE) if job.options else {}
+
+    try:
+        if job.rag:
+            result, job.served_by = router.generate(exec_ollama_rag, job.model, "source_title: " + str(news_item["headline"]), "descripcion: " + str(news_item["description"]), format_context(job.context), job.model, **request_options)
+        else:
+            result, job.served_by = router.generate(exec_ollama, job.model, "source_title: " + str(news_item["headline"]), "source_description: " + str(news_item["description"]), job.model, **request_options)
+    except Exception as e:
+        print("Error processing news with Ollama:", e)
+        result = None
+
+    if result is None or not result.ok:
+        with data_lock:
+            error_count += 1
+        return False
+
+    document = {
+        "RAG": job.rag,
+        "id_news": news_item["_id"],
+        "date_stored": int(news_item["date_stored"]),
+        "timestamp_llm": int(datetime.now().timestamp()),
+        "id_feature": job.id_feature,
+        "id_llm": id_llm,
+    }
+    if job.rag:
+        document["context"] = job.context
+    document["synthetic_description"] = result.synthetic_description
+    document.update(result.document_fields())
+
+    # --- Send to API (batched) ---
+    buffer.add(job.newspaper, document)
+    with data_lock:
+        if job.rag:
+            num_generated_news_RAG += 1
+        else:
+            num_generated_news_NO_RAG += 1
+    print(f"[{job.served_by}-F{job.id_feature}] {label} Generated ({result.summary()})")
+
+    return True
 
 # --- Main Execution ---
 if __name__ == '__main__':
@@ -186,10 +255,29 @@ if __name__ == '__main__':
     
     parser.add_argument('--ollama_ip', default="localhost", help="IP Ollama")
     parser.add_argument('--ollama_port', type=int, default=11434, help="Puerto Ollama")
+    parser.add_argument('--ollama_endpoints', default=None, help="Lista de servidores Ollama ip:puerto separados por comas (sustituye a --ollama_ip/--ollama_port)")
     
     parser.add_argument('--llm_api_ip', default="localhost", help="IP API LLM Wrapper")
     parser.add_argument('--llm_api_port', type=int, default=6002, help="Puerto API LLM Wrapper")
 
+    parser.add_argument('--max_inflight', type=int, default=2, help="Peticiones simultáneas máximas por servidor Ollama")
+    parser.add_argument('--batch_size', type=int, default=50, help="Documentos por envío masivo a la API de guardado")
+    parser.add_argument('--batch_wait', type=float, default=10.0, help="Segundos máximos antes de enviar un lote incompleto")
+    parser.add_argument('--embed_batch_size', type=int, default=32, help="Tamaño de lote al codificar los titulares de consulta")
+    parser.add_argument('--retrieval_cache_file', default=None, help="Fichero JSON para persistir la caché de recuperación entre ejecuciones")
+    parser.add_argument('--manifest', default=None, help="Fichero JSONL con las generaciones ya guardadas (por defecto manifests/<modelo><id_llm>.jsonl)")
+    parser.add_argument('--resume', action='store_true', help="Saltar las generaciones registradas en el manifiesto")
+    parser.add_argument('--one_per_cluster', action='store_true', help="Generar una sola vez por grupo de noticias casi duplicadas (cluster_id)")
+    parser.add_argument('--model_batch', type=int, default=24, help="Trabajos seguidos del mismo modelo antes de cambiar de modelo (0 = orden original)")
+    parser.add_argument('--no_time_filter', action='store_true', help="Recuperar también noticias posteriores al titular (colecciones sin metadatos)")
+    parser.add_argument('--max_age_days', type=float, default=None, help="Días hacia atrás en los que se buscan noticias para el contexto")
+    parser.add_argument('--max_distance', type=float, default=None, help="Distancia máxima de un pasaje a la consulta para entrar en el contexto")
+    parser.add_argument('--cross_newspaper', action='store_true', help="Buscar el contexto en la colección de todos los periódicos")
+    parser.add_argument('--context_tokens', type=int, default=CONTEXT_TOKEN_BUDGET, help="Tokens máximos del contexto RAG en el prompt")
+    parser.add_argument('--context_tokenizer', default=None, help="Tokenizador de Hugging Face para contar los tokens del contexto (por defecto, el del prefijo del modelo)")
+    parser.add_argument('--shared_base', action='store_true', help="Usar un modelo base por familia (RAG / NO_RAG) y enviar la temperatura en cada petición")
+    parser.add_argument('--http_pool_size', type=int, default=http_sessions.POOL_SIZE, help="Conexiones keep-alive por servicio")
+
     args = parser.parse_args()
 
     # --- 2. Configuration Setup ---
@@ -202,10 +290,13 @@ if __name__ == '__main__':
     LLM_API_IP = args.llm_api_ip
     LLM_API_PORT = args.llm_api_port
 
+    http_sessions.configure(pool_size=args.http_pool_size)
+
     print("=== CONFIGURACIÓN DE RED ACTIVA ===")
     print(f"API Noticias: {API_IP}:{REAL_API_PORT}")
     print(f"ChromaDB:     {CHROMADB_IP}:{CHROMADB_PORT}")
-    print(f"Ollama:       {OLLAMA_IP}:{OLLAMA_PORT}")
+    ollama_endpoints = args.ollama_endpoints or f"{OLLAMA_IP}:{OLLAMA_PORT}"
+    print(f"Ollama:       {ollama_endpoints}")
     print(f"API Guardado: {LLM_API_IP}:{LLM_API_PORT}")
     print("===================================")
 
@@ -221,58 +312,68 @@ if __name__ == '__main__':
         print("Error: Formato de fecha incorrecto. Use dd-mm-yyyy")
         sys.exit(1)
 
-    print(f"Iniciando proceso multihilo del {start_date.date()} al {end_date.date()}")
+    print(f"Iniciando proceso concurrente del {start_date.date()} al {end_date.date()}")
     print(f"Modelo: {args.model} | ID LLM: {args.id_llm}")
 
     start_hour = 0
     end_hour = 23
     
     chroma_client = chromadb.HttpClient(host=CHROMADB_IP, port=CHROMADB_PORT)
-    embedding_fn = embedding_functions.SentenceTransformerEmbeddingFunction(
-     model_name="intfloat/multilingual-e5-large"
-    )
+    # Headlines are embedded locally in batches ('intfloat/multilingual-e5-large')
+    query_embedder = QueryEmbedder(batch_size=args.embed_batch_size)
 
     features = [3,2,1] 
+    retrieval_cache = RetrievalCache(path=args.retrieval_cache_file)
+    manifest = RunManifest(args.manifest or f"manifests/{args.model}{args.id_llm}.jsonl")
+    if args.resume:
+        print(f"Reanudando: {len(manifest)} generaciones ya guardadas en {manifest.path}")
     
     # --- 4. Main Loop ---
     newspapers_list = get_newspapers()
+    backend_summary = []
     
     if newspapers_list:
-        for newspaper in newspapers_list["newspapers"]:
-            
-            collection = chroma_client.get_or_create_collection(name="real_news_data_" + str(newspaper), embedding_function=embedding_fn)
-            
-            threads = []
-            
-            for id_feature in features:
-                print(f"Lanzando hilo -> Newspaper: {newspaper}, Feature: {id_feature}")
-                
-                t = threading.Thread(target=process_feature_thread, args=(
-                    newspaper, 
-                    id_feature, 
-                    start_date, 
-                    end_date, 
-                    start_hour, 
-                    end_hour, 
-                    collection, 
-                    args.id_llm, 
-                    args.model 
-                ))
-                threads.append(t)
-                t.start()
-            
-            for t in threads:
-                t.join()
-            
-            print(f"--- Finalizados hilos para {newspaper} ---")
+        router = OllamaRouter(parse_endpoints(ollama_endpoints, args.max_inflight))
+        router.refresh()
+        scheduler = GenerationScheduler(max_inflight={OLLAMA_POOL: router.capacity})
+        buffer = LLMNewsBuffer(LLM_API_IP, LLM_API_PORT, args.batch_size, args.batch_wait, on_flush=lambda newspaper, documents, results: on_batch_stored(newspaper, documents, results, manifest))
+        if args.context_tokenizer:
+            context_builder = ContextBuilder(args.context_tokens, args.context_tokenizer)
+        else:
+            context_builder = ContextBuilder.for_model(args.model, args.context_tokens)
+        retrieval_options = {
+            "time_filter": not args.no_time_filter,
+            "max_age": args.max_age_days * 86400 if args.max_age_days else None,
+            "max_distance": args.max_distance,
+            "cross_newspaper": args.cross_newspaper,
+        }
+        jobs = generate_jobs(newspapers_list["newspapers"], chroma_client, query_embedder, start_date, end_date, start_hour, end_hour, args.model, features, retrieval_cache, args.id_llm, manifest if args.resume else None, args.one_per_cluster, args.shared_base, context_builder, retrieval_options)
+        # Jobs are grouped by model so the servers do not switch the loaded model on every item
+        jobs = batch_by_model(jobs, args.model_batch)
+        try:
+            backend_summary = scheduler.run(jobs, lambda job: run_job(job, args.id_llm, router, buffer))
+        finally:
+            buffer.close()
+            retrieval_cache.save()
 
     else:
         print("No se pudieron recuperar periódicos.")
 
+    manifest.close()
+
     print("\n================================================")
     print("RESUMEN DE EJECUCIÓN")
     print("Errores de Ollama: " + str(error_count))
     print("Noticias RAG generadas: " + str(num_generated_news_RAG))
     print("Noticias NO RAG generadas: " + str(num_generated_news_NO_RAG))
+    print("Errores de guardado: " + str(num_insert_errors))
+    print("Generaciones saltadas (ya guardadas): " + str(num_skipped))
+    print("Noticias saltadas (casi duplicadas): " + str(num_cluster_skipped))
+    print("Caché de recuperación: " + retrieval_cache.summary())
+    print("Llamadas a Ollama: " + ollama_metrics.summary())
+    if newspapers_list:
+        print("Cambios de modelo: " + router.switch_summary())
+    for row in backend_summary:
+        print(f"Backend {row['backend']}: {row['jobs']} trabajos, {row['errors']} errores, {row['jobs_per_sec']:.3f} trabajos/s")
     print("Hora fin: " + str(datetime.now()))
     print("================================================")
\ No newline at end of file
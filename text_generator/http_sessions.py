@@ -0,0 +1,107 @@
+import os
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Shared HTTP client for the generation scripts. Keeps one pooled keep-alive Session per
+# service (data_engine, context_manager, ollama) so consecutive calls reuse TCP connections,
+# and applies default timeouts and retry/backoff so a stalled service cannot hang a run.
+# Settings can be overridden with environment variables or with configure() before the
+# first request.
+
+DATA_ENGINE = "data_engine"
+CONTEXT_MANAGER = "context_manager"
+OLLAMA = "ollama"
+
+POOL_SIZE = int(os.environ.get("HTTP_POOL_SIZE", 16))
+CONNECT_TIMEOUT = float(os.environ.get("HTTP_CONNECT_TIMEOUT", 5))
+RETRIES = int(os.environ.get("HTTP_RETRIES", 3))
+BACKOFF_FACTOR = float(os.environ.get("HTTP_BACKOFF_FACTOR", 0.5))
+
+# Read timeouts (seconds) per service. Generation on CPU can take minutes.
+READ_TIMEOUTS = {
+    DATA_ENGINE: float(os.environ.get("HTTP_READ_TIMEOUT_DATA_ENGINE", 60)),
+    CONTEXT_MANAGER: float(os.environ.get("HTTP_READ_TIMEOUT_CONTEXT_MANAGER", 60)),
+    OLLAMA: float(os.environ.get("HTTP_READ_TIMEOUT_OLLAMA", 900)),
+}
+
+# Methods that may be retried after the request was sent. Ollama generations are not
+# idempotent, so they are only retried on connection errors. Inserts in context_manager are
+# (unique index on id_news/id_feature/id_llm; context_manager refuses inserts into a
+# collection without it), so a retried POST cannot duplicate documents.
+RETRY_METHODS = {
+    DATA_ENGINE: frozenset(["GET", "PUT"]),
+    CONTEXT_MANAGER: frozenset(["GET", "POST"]),
+    OLLAMA: frozenset(["GET"]),
+}
+
+_sessions = {}
+_lock = threading.Lock()
+
+
+# Overrides the pool/retry defaults. Only affects sessions created afterwards.
+def configure(pool_size=None, connect_timeout=None, retries=None, backoff_factor=None, read_timeouts=None):
+    global POOL_SIZE, CONNECT_TIMEOUT, RETRIES, BACKOFF_FACTOR
+    if pool_size is not None:
+        POOL_SIZE = pool_size
+    if connect_timeout is not None:
+        CONNECT_TIMEOUT = connect_timeout
+    if retries is not None:
+        RETRIES = retries
+    if backoff_factor is not None:
+        BACKOFF_FACTOR = backoff_factor
+    if read_timeouts:
+        READ_TIMEOUTS.update(read_timeouts)
+
+
+def _build_session(service):
+    retry = Retry(
+        total=RETRIES,
+        connect=RETRIES,
+        read=RETRIES,
+        status=RETRIES,
+        backoff_factor=BACKOFF_FACTOR,
+        status_forcelist=(502, 503, 504),
+        allowed_methods=RETRY_METHODS.get(service, frozenset(["GET"])),
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=POOL_SIZE, max_retries=retry)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+# Returns the pooled Session of a service (created on first use).
+def get_session(service):
+    session = _sessions.get(service)
+    if session is None:
+        with _lock:
+            session = _sessions.get(service)
+            if session is None:
+                session = _build_session(service)
+                _sessions[service] = session
+    return session
+
+
+def default_timeout(service):
+    return (CONNECT_TIMEOUT, READ_TIMEOUTS.get(service, 60))
+
+
+# Sends a request through the service Session, applying the default timeout.
+def request(service, method, url, **kwargs):
+    kwargs.setdefault("timeout", default_timeout(service))
+    return get_session(service).request(method, url, **kwargs)
+
+
+def get(service, url, **kwargs):
+    return request(service, "GET", url, **kwargs)
+
+
+def post(service, url, **kwargs):
+    return request(service, "POST", url, **kwargs)
+
+
+def put(service, url, **kwargs):
+    return request(service, "PUT", url, **kwargs)
@@ -0,0 +1,79 @@
+import threading
+import time
+import requests
+
+import http_sessions
+
+# Write buffer for the synthetic news. Collects the generated documents per newspaper and
+# sends them to the context_manager bulk endpoint (POST /newsLLM/<newspaper>/bulk) when a
+# batch reaches `batch_size` documents or its oldest document is `max_wait` seconds old,
+# so the number of storage round-trips does not grow with the number of items.
+
+
+class LLMNewsBuffer:
+    def __init__(self, api_ip, api_port, batch_size=50, max_wait=10.0, on_flush=None):
+        self.base_url = "http://" + str(api_ip) + ":" + str(api_port) + "/newsLLM/"
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        # Optional callback on_flush(newspaper, documents, results); results is None on failure
+        self.on_flush = on_flush
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._first_added = {}
+        self._stop = threading.Event()
+        self._timer = threading.Thread(target=self._flush_expired_loop, daemon=True)
+        self._timer.start()
+
+    def add(self, newspaper, document):
+        batch = None
+        with self._lock:
+            pending = self._pending.setdefault(newspaper, [])
+            if not pending:
+                self._first_added[newspaper] = time.monotonic()
+            pending.append(document)
+            if len(pending) >= self.batch_size:
+                batch = self._take(newspaper)
+        if batch:
+            self._send(newspaper, batch)
+
+    def flush(self):
+        with self._lock:
+            batches = [(newspaper, self._take(newspaper)) for newspaper in list(self._pending)]
+        for newspaper, batch in batches:
+            if batch:
+                self._send(newspaper, batch)
+
+    # Stops the background timer and sends everything that is still buffered.
+    def close(self):
+        self._stop.set()
+        self._timer.join()
+        self.flush()
+
+    def _take(self, newspaper):
+        self._first_added.pop(newspaper, None)
+        return self._pending.pop(newspaper, [])
+
+    def _flush_expired_loop(self):
+        while not self._stop.wait(min(1.0, self.max_wait)):
+            now = time.monotonic()
+            with self._lock:
+                expired = [n for n, t in self._first_added.items() if now - t >= self.max_wait]
+                batches = [(newspaper, self._take(newspaper)) for newspaper in expired]
+            for newspaper, batch in batches:
+                self._send(newspaper, batch)
+
+    def _send(self, newspaper, documents):
+        results = None
+        try:
+            response = http_sessions.post(http_sessions.CONTEXT_MANAGER, self.base_url + newspaper + "/bulk", json=documents)
+            if response.status_code in (201, 207):
+                body = response.json()
+                results = body.get("results", [])
+                print(f"[{newspaper}] Bulk insert: {body.get('inserted', 0)} inserted, {body.get('duplicates', 0)} duplicates, {body.get('errors', 0)} errors")
+            else:
+                print(f"Error bulk API {newspaper}: {response.status_code}: {response.text}")
+        except (requests.exceptions.RequestException, ValueError) as e:
+            print("Error connecting to Storage API:", e)
+
+        if self.on_flush:
+            self.on_flush(newspaper, documents, results)
@@ -6,11 +6,16 @@ from ollama import chat
 from ollama import Client
 import re
 import chromadb
-from chromadb.utils import embedding_functions
 import argparse 
 import sys
 
-from ollama_execution import exec_ollama, exec_ollama_rag
+import http_sessions
+from ollama_execution import exec_ollama, exec_ollama_rag, OllamaRouter, parse_endpoints, metrics as ollama_metrics, model_name, variant_options, KEEP_ALIVE
+from context_builder import CONTEXT_TOKEN_BUDGET, ContextBuilder, format_context
+from llm_news_buffer import LLMNewsBuffer
+from retrieval_cache import CROSS_NEWSPAPER_COLLECTION, RetrievalCache
+from query_embedder import QueryEmbedder
+from run_manifest import RunManifest
 
 # --- Configuration Constants (IP addresses and ports for services) ---
 API_IP = "localhost"
@@ -32,7 +37,7 @@ def remove_html(text):
 def get_newspapers():
     url = str("http://") + API_IP + ":" + str(REAL_API_PORT) + "/newspapers"
     try:
-        response = requests.get(url)
+        response = http_sessions.get(http_sessions.DATA_ENGINE, url)
         response.raise_for_status()
         return response.json()
     except requests.exceptions.RequestException as e:
@@ -44,7 +49,7 @@ def read_newspaper_news(newspaper, date, shour, sminute, ehour, eminute):
     url = str("http://") + API_IP + ":" + str(REAL_API_PORT) + "/news/" + newspaper + "?"
     
     try:
-        response = requests.get(url, params=params)
+        response = http_sessions.get(http_sessions.DATA_ENGINE, url, params=params)
         response.raise_for_status()
         return response.json()
     except requests.exceptions.RequestException as e:
@@ -57,13 +62,28 @@ def update_news(newspaper, news_id, tag, tag_value):
     data = {tag: tag_value}
     print("Data:" + str(data))
     try:
-        response = requests.put(url, json=data, headers=headers)
+        response = http_sessions.put(http_sessions.DATA_ENGINE, url, json=data, headers=headers)
         response.raise_for_status()
         return response.json()
     except requests.exceptions.RequestException as e:
         print(f"Error updating entry: {e}")
         return None
 
+# Runs one generation through the router. Returns the GenerationResult, or None when the
+# call failed (no healthy endpoint, HTTP error or no valid JSON after the retries); each failed
+# generation is counted once in error_count.
+def generate_description(router, fn, model, *args, **kwargs):
+    global error_count
+    try:
+        result = router.generate(fn, model, *args, **kwargs)[0]
+    except Exception as e:
+        print("Error processing news with Ollama:", e)
+        result = None
+    if result is None or not result.ok:
+        error_count += 1
+        return None
+    return result
+
 if __name__ == '__main__':
 
     # --- BLOQUE DE ARGUMENTOS ---
@@ -76,6 +96,34 @@ if __name__ == '__main__':
     # --- NUEVOS ARGUMENTOS DE FECHA ---
     parser.add_argument('--sdate', required=True, type=str, help='Fecha de inicio en formato dd-mm-yyyy')
     parser.add_argument('--edate', required=True, type=str, help='Fecha de fin en formato dd-mm-yyyy')
+
+    parser.add_argument('--batch_size', default=50, type=int, help='Documentos por envío masivo a la API de guardado')
+    parser.add_argument('--batch_wait', default=10.0, type=float, help='Segundos máximos antes de enviar un lote incompleto')
+    parser.add_argument('--embed_batch_size', default=32, type=int, help='Tamaño de lote al codificar los titulares de consulta')
+    parser.add_argument('--retrieval_cache_file', default=None, type=str, help='Fichero JSON para persistir la caché de recuperación entre ejecuciones')
+
+    # Manifiesto de generaciones guardadas, para reanudar una ejecución interrumpida
+    parser.add_argument('--manifest', default=None, type=str, help='Fichero JSONL con las generaciones ya guardadas (por defecto manifests/<modelo><id_llm>.jsonl)')
+    parser.add_argument('--resume', action='store_true', help='Saltar las generaciones registradas en el manifiesto')
+
+    # Generar una sola vez por grupo de noticias casi duplicadas (cluster_id asignado por el data engine)
+    parser.add_argument('--one_per_cluster', action='store_true', help='Generar una sola vez por cluster de noticias casi duplicadas')
+
+    # Servidores Ollama (ip:puerto separados por comas); cada petición va al menos ocupado que tenga el modelo
+    parser.add_argument('--ollama_endpoints', default=f"{OLLAMA_IP}:{OLLAMA_PORT}", type=str, help='Servidores Ollama ip:puerto separados por comas')
+
+    # Contexto RAG: pasajes sin duplicados y recortados a un presupuesto de tokens
+    parser.add_argument('--context_tokens', default=CONTEXT_TOKEN_BUDGET, type=int, help='Tokens máximos del contexto RAG en el prompt')
+    parser.add_argument('--context_tokenizer', default=None, type=str, help='Tokenizador de Hugging Face para contar los tokens del contexto (por defecto, el del prefijo del modelo)')
+
+    # Recuperación RAG: solo noticias anteriores al titular, con límite de antigüedad y de distancia opcionales
+    parser.add_argument('--no_time_filter', action='store_true', help='Recuperar también noticias posteriores al titular (colecciones sin metadatos)')
+    parser.add_argument('--max_age_days', default=None, type=float, help='Días hacia atrás en los que se buscan noticias para el contexto')
+    parser.add_argument('--max_distance', default=None, type=float, help='Distancia máxima de un pasaje a la consulta para entrar en el contexto')
+    parser.add_argument('--cross_newspaper', action='store_true', help='Buscar el contexto en la colección de todos los periódicos')
+
+    # Un modelo base por familia (RAG / NO_RAG) con la temperatura enviada en cada petición
+    parser.add_argument('--shared_base', action='store_true', help='Usar un modelo base por familia y enviar la temperatura en cada petición')
     
     args = parser.parse_args()
     
@@ -106,119 +154,159 @@ if __name__ == '__main__':
     # Initialize counters
     num_generated_news_NO_RAG = 0
     num_generated_news_RAG = 0
+    num_skipped = 0
+    num_cluster_skipped = 0
     error_count = 0
+    seen_clusters = {}  # id_feature -> cluster_ids already generated
+
+    manifest = RunManifest(args.manifest or f"manifests/{cli_model_name}{cli_id_llm}.jsonl")
+    if args.resume:
+        print(f"Reanudando: {len(manifest)} generaciones ya guardadas en {manifest.path}")
     
+    router = OllamaRouter(parse_endpoints(args.ollama_endpoints))
+    router.refresh()
+
+    # Documents are sent to the LLM API in batches of --batch_size (or every --batch_wait seconds)
+    # and recorded in the manifest once stored
+    buffer = LLMNewsBuffer(LLM_API_IP, LLM_API_PORT, args.batch_size, args.batch_wait, on_flush=lambda newspaper, documents, results: manifest.record(documents, results))
+
     # Initialize ChromaDB client
     chroma_client = chromadb.HttpClient(host=CHROMADB_IP, port=CHROMADB_PORT)
-    embedding_fn = embedding_functions.SentenceTransformerEmbeddingFunction(
-     model_name="intfloat/multilingual-e5-large"
-    )
+    # Headlines are embedded locally in batches ('intfloat/multilingual-e5-large')
+    query_embedder = QueryEmbedder(batch_size=args.embed_batch_size)
 
     features = [3,2,1]  # Temperatures
+    retrieval_cache = RetrievalCache(path=args.retrieval_cache_file)
+    if args.context_tokenizer:
+        context_builder = ContextBuilder(args.context_tokens, args.context_tokenizer)
+    else:
+        context_builder = ContextBuilder.for_model(cli_model_name, args.context_tokens)
     
-    # Main processing loop
-    newspapers_data = get_newspapers()
-    if newspapers_data:
-        for newspaper in newspapers_data.get("newspapers", []):
+    # Main processing loop. Buffered documents, the manifest and the retrieval cache are saved
+    # even if it fails.
+    try:
+        newspapers_data = get_newspapers()
+        if newspapers_data:
+            for newspaper in newspapers_data.get("newspapers", []):
             
-            for id_feature in features:
+                for id_feature in features:
                 
-                modelo = cli_model_name 
-                id_llm = cli_id_llm  
+                    modelo = cli_model_name 
+                    id_llm = cli_id_llm  
                 
-                model_NO_RAG = modelo + "LLM_resumen_NO_RAG_T"+str(id_feature)
-                model_RAG = modelo + "LLM_resumen_RAG_T"+str(id_feature)
+                    model_NO_RAG = model_name(modelo, 0, id_feature, args.shared_base)
+                    model_RAG = model_name(modelo, 1, id_feature, args.shared_base)
+                    # With --shared_base the temperature variant is sent as request options
+                    request_options = dict(options=variant_options(id_feature), keep_alive=KEEP_ALIVE) if args.shared_base else {}
 
-                collection = chroma_client.get_or_create_collection(name="real_news_data_" + str(newspaper), embedding_function=embedding_fn)
-                endpoint_url = "http://" + str(LLM_API_IP) + ":" + str(LLM_API_PORT) + "/newsLLM/" + newspaper
+                    collection_name = CROSS_NEWSPAPER_COLLECTION if args.cross_newspaper else "real_news_data_" + str(newspaper)
+                    collection = chroma_client.get_or_create_collection(name=collection_name, embedding_function=None)
                 
-                # Bucle de fechas: Calculamos la diferencia de días basándonos en los argumentos
-                delta_days = (end_date - start_date).days
+                    # Bucle de fechas: Calculamos la diferencia de días basándonos en los argumentos
+                    delta_days = (end_date - start_date).days
                 
-                for i in range(delta_days + 1):
-                    current_date = start_date + timedelta(days=i)
-                    day = current_date.day
-                    month = current_date.month
-                    year = current_date.year
+                    for i in range(delta_days + 1):
+                        current_date = start_date + timedelta(days=i)
+                        day = current_date.day
+                        month = current_date.month
+                        year = current_date.year
                 
-                    print(f"Procesando fecha: {day}-{month}-{year} para {newspaper}")
+                        print(f"Procesando fecha: {day}-{month}-{year} para {newspaper}")
 
-                    # Llamada a la API de noticias reales
-                    news_response = read_newspaper_news(newspaper, str(day) + "-" + str(month) + "-" + str(year), str(start_hour), "00", str(end_hour), "00")
+                        # Llamada a la API de noticias reales
+                        news_response = read_newspaper_news(newspaper, str(day) + "-" + str(month) + "-" + str(year), str(start_hour), "00", str(end_hour), "00")
                     
-                    if news_response and "items" in news_response:
-                        for news_item in news_response["items"]:
+                        if news_response and "items" in news_response:
+                            # All the headlines of the day are embedded and searched in one batch;
+                            # the same headlines for the other temperatures are served from the cache
+                            # Only news stored before each headline are searched (unless --no_time_filter)
+                            described_items = [news_item for news_item in news_response["items"] if news_item.get("description")]
+                            headlines = [news_item["headline"] for news_item in described_items]
+                            before = None if args.no_time_filter else [int(news_item["date_stored"]) for news_item in described_items]
+                            max_age = args.max_age_days * 86400 if args.max_age_days else None
+                            contexts = iter(retrieval_cache.query_batch(collection, headlines, query_embedder, n_results=10, before=before, max_age=max_age, max_distance=args.max_distance) if headlines else [])
+
+                            for news_item in news_response["items"]:
                             
-                            document_NO_RAG = dict()
-                            document_RAG = dict()
-
-                            if news_item.get("description"):
-                                query_text = news_item["headline"]
-                                results = collection.query(
-                                        query_texts=[query_text],
-                                        n_results=10 
-                                    )
-                                context = results["documents"]
-                                print("contexto: " + str(context))
-                                
-                                news_item["description"] = remove_html(news_item["description"])
+                                document_NO_RAG = dict()
+                                document_RAG = dict()
+
+                                if news_item.get("description"):
+                                    context = next(contexts)
+
+                                    cluster_id = news_item.get("cluster_id")
+                                    if args.one_per_cluster and cluster_id:
+                                        if cluster_id in seen_clusters.setdefault(id_feature, set()):
+                                            num_cluster_skipped += 1
+                                            continue
+                                        seen_clusters[id_feature].add(cluster_id)
+
+                                    news_item["description"] = remove_html(news_item["description"])
+                                    context = context_builder.select(context, news_item["description"])
+                                    print("contexto: " + str(context))
                                 
-                                try:
                                     print("title: " + news_item["headline"])
-                                    
-                                    # Generate synthetic description WITHOUT RAG
-                                    document_NO_RAG = {
-                                    "RAG": 0,
-                                    "id_news": news_item["_id"],
-                                    "timestamp_llm": int(datetime.now().timestamp()),
-                                    "id_feature": id_feature,
-                                    "id_llm": id_llm,
-                                    "synthetic_description": exec_ollama(None, OLLAMA_IP, OLLAMA_PORT, "source_title: " + str(news_item["headline"]), "source_description: " + str(news_item["description"]), model_NO_RAG).get("synthetic_description", "N/A"),
-                                    }
-                                    print("NO RAG: " + str(document_NO_RAG))
-
-                                    # Generate synthetic description WITH RAG
-                                    document_RAG = {
-                                    "RAG": 1,
-                                    "id_news": news_item["_id"],
-                                    "timestamp_llm": int(datetime.now().timestamp()),
-                                    "id_feature": id_feature,
-                                    "id_llm": id_llm,
-                                    "context": context[0],
-                                    "synthetic_description": exec_ollama_rag(None, OLLAMA_IP, OLLAMA_PORT, "source_title: " + str(news_item["headline"]), "descripcion: " + str(news_item["description"]), context, model_RAG).get("synthetic_description", "N/A"),
-                                    }
-                                    print("Yes RAG: " + str(document_RAG))
-                        
-                                    # Send generated documents
-                                    try:
-                                        if document_RAG:
-                                            response = requests.post(endpoint_url, json=document_RAG)
-                                            num_generated_news_RAG += 1
-                                            if response.status_code == 201:
-                                                print("RAG Document inserted successfully")
-                                            else:
-                                                print(f"Error {response.status_code}: {response.text}")
-
-                                        if document_NO_RAG:
-                                            response = requests.post(endpoint_url, json=document_NO_RAG)
-                                            num_generated_news_NO_RAG += 1
-                                            if response.status_code == 201:
-                                                print("NO-RAG Document inserted successfully")
-                                            else:
-                                                print(f"Error {response.status_code}: {response.text}")
-
-                                    except requests.exceptions.RequestException as e:
-                                        print("Error connecting to API:", e)
-                                    
-                                except Exception as e:
-                                    print("Error processing news with Ollama:", e)
-                                    error_count += 1
-    else:
-        print("No se pudieron obtener periódicos.")
+
+                                    # Generate synthetic description WITHOUT RAG (unless stored by a previous run)
+                                    if args.resume and manifest.is_done(news_item["_id"], id_feature, id_llm, 0):
+                                        num_skipped += 1
+                                    else:
+                                        result = generate_description(router, exec_ollama, model_NO_RAG, "source_title: " + str(news_item["headline"]), "source_description: " + str(news_item["description"]), model_NO_RAG, **request_options)
+                                        if result is not None:
+                                            document_NO_RAG = {
+                                            "RAG": 0,
+                                            "id_news": news_item["_id"],
+                                            "date_stored": int(news_item["date_stored"]),
+                                            "timestamp_llm": int(datetime.now().timestamp()),
+                                            "id_feature": id_feature,
+                                            "id_llm": id_llm,
+                                            "synthetic_description": result.synthetic_description,
+                                            **result.document_fields(),
+                                            }
+                                            print("NO RAG: " + str(document_NO_RAG))
+
+                                    # Generate synthetic description WITH RAG (unless stored by a previous run)
+                                    if args.resume and manifest.is_done(news_item["_id"], id_feature, id_llm, 1):
+                                        num_skipped += 1
+                                    else:
+                                        result = generate_description(router, exec_ollama_rag, model_RAG, "source_title: " + str(news_item["headline"]), "descripcion: " + str(news_item["description"]), format_context(context), model_RAG, **request_options)
+                                        if result is not None:
+                                            document_RAG = {
+                                            "RAG": 1,
+                                            "id_news": news_item["_id"],
+                                            "date_stored": int(news_item["date_stored"]),
+                                            "timestamp_llm": int(datetime.now().timestamp()),
+                                            "id_feature": id_feature,
+                                            "id_llm": id_llm,
+                                            "context": context,
+                                            "synthetic_description": result.synthetic_description,
+                                            **result.document_fields(),
+                                            }
+                                            print("Yes RAG: " + str(document_RAG))
+
+                                    # Buffer generated documents; they are stored in bulk batches
+                                    if document_RAG:
+                                        buffer.add(newspaper, document_RAG)
+                                        num_generated_news_RAG += 1
+
+                                    if document_NO_RAG:
+                                        buffer.add(newspaper, document_NO_RAG)
+                                        num_generated_news_NO_RAG += 1
+        else:
+            print("No se pudieron obtener periódicos.")
+    finally:
+        buffer.close()
+        manifest.close()
+        retrieval_cache.save()
 
     # Print final execution statistics
     print("------------------------------------------------")
     print("The number of Ollama errors was: " + str(error_count))
     print("The number of generated RAG news was: " + str(num_generated_news_RAG))
     print("The number of generated NO RAG news was: " + str(num_generated_news_NO_RAG))
+    print("The number of skipped (already stored) generations was: " + str(num_skipped))
+    print("The number of skipped near-duplicate news was: " + str(num_cluster_skipped))
+    print("Retrieval cache: " + retrieval_cache.summary())
+    print("Ollama calls: " + ollama_metrics.summary())
+    print("Model switches: " + router.switch_summary())
     print("End time: " + str(datetime.now()))
\ No newline at end of file
@@ -1,124 +1,403 @@
 import json
-from datetime import datetime, timedelta
-from ollama import chat
-from ollama import Client
+import os
 import re
 import requests
+import threading
+import time
+from dataclasses import dataclass
+from typing import Optional
+
+import http_sessions
 
 # Module handling interactions with the Ollama API. It constructs prompts, 
-# manages HTTP requests for standard and RAG-based generation, and parses the resulting JSON output.
+# sends standard and RAG-based generation requests, and parses the resulting JSON output.
+# Requests are not streamed and use Ollama's JSON mode (format: "json"), so the server
+# constrains the output to valid JSON; answers that still cannot be used are generated again,
+# up to MAX_JSON_RETRIES times per call. Every call returns a GenerationResult with the
+# latency and token counts reported by Ollama, aggregated in `metrics`.
+
+# JSON mode is supported by both servers (0.1.25 and 0.2.1). JSON schemas in `format` need
+# Ollama >= 0.5, so the expected fields are checked here instead.
+OLLAMA_FORMAT = "json"
+# Extra generations allowed per call when the answer is not valid JSON
+MAX_JSON_RETRIES = int(os.environ.get("OLLAMA_MAX_JSON_RETRIES", 2))
+
+# Shared-base mode: the three temperature variants of a family (RAG / NO_RAG) have the same
+# Modelfile apart from the temperature, so they can be served by one loaded model (the T1
+# one) with the sampling parameters sent per request. Requests for the same news item and
+# family then share the whole prompt, and the llama.cpp runner reuses the KV cache of the
+# common prefix instead of evaluating the system prompt and the RAG context again.
+# Ollama's `context` field is not used for this: it would append the previous answer to
+# the conversation and change the outputs.
+TEMPERATURES = {1: 1.0, 2: 0.75, 3: 0.5}
+SAMPLING_OPTIONS = {"num_predict": 256, "top_k": 50, "top_p": 0.9}
+# How long the server keeps the model loaded after a request
+KEEP_ALIVE = os.environ.get("OLLAMA_KEEP_ALIVE", "30m")
+
+
+# Name of the Ollama model of a variant (id_feature = temperature variant T1..T3). With
+# shared_base every variant of the family uses the T1 model.
+def model_name(prefix, rag, id_feature, shared_base=False):
+    family = "RAG" if rag else "NO_RAG"
+    return f"{prefix}LLM_resumen_{family}_T{1 if shared_base else id_feature}"
 
-# Global error counter (assuming it is defined in the main scope)
+
+# Per-request options reproducing the Modelfile parameters of a temperature variant
+def variant_options(id_feature):
+    return dict(SAMPLING_OPTIONS, temperature=TEMPERATURES[id_feature])
+
+
+# A call whose load_duration exceeds this many seconds had to load the model (a model that
+# is already loaded reports a few milliseconds)
+MODEL_LOAD_THRESHOLD_SEC = float(os.environ.get("OLLAMA_MODEL_LOAD_THRESHOLD", 0.5))
+
+# Global error counter (calls that ended without a usable answer), see count_error()
 error_count = 0
+_error_lock = threading.Lock()
 
-# Executes a standard (No-RAG) generation request to Ollama. 
-def exec_ollama(prompt_input, ollama_ip, ollama_port, title, description, model):
-    url = f"http://{ollama_ip}:{ollama_port}/api/generate"
 
-    # Prompt construction (Spanish content preserved, variables updated to English)
+def count_error():
+    global error_count
+    with _error_lock:
+        error_count += 1
+
+
+# Result of one generation call. The output fields follow the Modelfile JSON structure;
+# durations are in seconds (Ollama reports nanoseconds).
+@dataclass
+class GenerationResult:
+    model: str
+    output: Optional[dict] = None
+    raw_text: str = ""
+    error: Optional[str] = None
+    attempts: int = 0
+    latency_sec: float = 0.0
+    load_duration_sec: float = 0.0
+    prompt_eval_count: int = 0
+    prompt_eval_duration_sec: float = 0.0
+    eval_count: int = 0
+    eval_duration_sec: float = 0.0
+
+    @property
+    def ok(self):
+        return self.output is not None
+
+    @property
+    def synthetic_description(self):
+        return self.output.get("synthetic_description", "N/A") if self.output else None
+
+    @property
+    def fidelity_score(self):
+        return self.output.get("fidelity_score") if self.output else None
+
+    @property
+    def human_review_needed(self):
+        return self.output.get("human_review_needed") if self.output else None
+
+    @property
+    def eval_tokens_per_sec(self):
+        return self.eval_count / self.eval_duration_sec if self.eval_duration_sec else 0.0
+
+    # Per-call figures stored with the generated document
+    def document_fields(self):
+        return {
+            "llm_latency_sec": round(self.latency_sec, 3),
+            "prompt_eval_count": self.prompt_eval_count,
+            "eval_count": self.eval_count,
+            "llm_attempts": self.attempts,
+        }
+
+    # One-line summary for the logs, e.g. "12.41s, 812 prompt tokens, 176 generated tokens, 1 attempt"
+    def summary(self):
+        return (f"{self.latency_sec:.2f}s, {self.prompt_eval_count} prompt tokens, {self.eval_count} generated tokens, "
+                f"{self.attempts} attempt{'s' if self.attempts != 1 else ''}")
+
+    # Adds the Ollama metadata of one attempt (retries add up)
+    def add_timings(self, data):
+        self.load_duration_sec += data.get("load_duration", 0) / 1e9
+        self.prompt_eval_count += data.get("prompt_eval_count", 0)
+        self.prompt_eval_duration_sec += data.get("prompt_eval_duration", 0) / 1e9
+        self.eval_count += data.get("eval_count", 0)
+        self.eval_duration_sec += data.get("eval_duration", 0) / 1e9
+
+
+# Thread-safe totals of the generation calls of a run.
+class GenerationMetrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.failures = 0
+        self.json_retries = 0
+        self.model_loads = 0
+        self.load_duration_sec = 0.0
+        self.latency_sec = 0.0
+        self.prompt_eval_count = 0
+        self.prompt_eval_duration_sec = 0.0
+        self.eval_count = 0
+        self.eval_duration_sec = 0.0
+
+    def record(self, result):
+        with self._lock:
+            self.calls += 1
+            self.failures += 0 if result.ok else 1
+            self.json_retries += max(result.attempts - 1, 0)
+            self.model_loads += 1 if result.load_duration_sec >= MODEL_LOAD_THRESHOLD_SEC else 0
+            self.load_duration_sec += result.load_duration_sec
+            self.latency_sec += result.latency_sec
+            self.prompt_eval_count += result.prompt_eval_count
+            self.prompt_eval_duration_sec += result.prompt_eval_duration_sec
+            self.eval_count += result.eval_count
+            self.eval_duration_sec += result.eval_duration_sec
+
+    def summary(self):
+        with self._lock:
+            if not self.calls:
+                return "0 calls"
+            prompt_rate = self.prompt_eval_count / self.prompt_eval_duration_sec if self.prompt_eval_duration_sec else 0.0
+            eval_rate = self.eval_count / self.eval_duration_sec if self.eval_duration_sec else 0.0
+            return (f"{self.calls} calls, {self.failures} failed, {self.json_retries} JSON retries, "
+                    f"{self.latency_sec / self.calls:.2f}s mean latency, "
+                    f"{self.model_loads} model loads ({self.load_duration_sec:.1f}s), "
+                    f"{self.prompt_eval_count} prompt tokens ({prompt_rate:.1f} tok/s), "
+                    f"{self.eval_count} generated tokens ({eval_rate:.1f} tok/s)")
+
+
+metrics = GenerationMetrics()
+
+
+# Prompt of the summary models (Spanish instructions are part of the Modelfile contract)
+def build_prompt(title, description, context=None):
     prompt = (
         f"source_title: {title}\n"
         f"target_word_count: {len(description.split())}\n"
-        "INSTRUCCIONES: Genera un JSON siguiendo las reglas definidas en el Modelfile."
-    )
-
-    response = requests.post(
-        url,
-        json={"model": model, "prompt": prompt},
-        stream=True
     )
+    if context is not None:
+        prompt += f"context: {context}\n"
+    return prompt + "INSTRUCCIONES: Genera un JSON siguiendo las reglas definidas en el Modelfile."
 
-    full_text = ""
-    for line in response.iter_lines():
-        if not line:
-            continue
-        try:
-            data = json.loads(line.decode("utf-8"))
-        except json.JSONDecodeError:
-            continue  # ignore non-JSON lines
-        
-        # Concatenate partial texts
-        if "response" in data and data["response"]:
-            full_text += data["response"]
-
-    if not full_text.strip():
-        print("The LLM did not return text")
-        return None
 
-    # Parse final JSON (if your prompt requests JSON)
+# Parses the answer of the model. Returns the output dict, or None when it is not a JSON
+# object with a synthetic_description.
+def parse_output(text):
+    text = re.sub(r"^```json\s*|```$", "", text.strip(), flags=re.MULTILINE).strip()
     try:
-        full_text = full_text.strip()
-        full_text = re.sub(r"^```json\s*|```$", "", full_text, flags=re.MULTILINE).strip()
-        output = json.loads(full_text.strip())
+        output = json.loads(text)
     except json.JSONDecodeError:
-        print("Could not parse JSON. Raw response:")
-        print(full_text)
-        
-        # Handling the global counter
-        global error_count
-        error_count += 1
-
         return None
-    
+    if not isinstance(output, dict) or "synthetic_description" not in output:
+        return None
+
     # Normalize fields
     if "changes_made" in output and isinstance(output["changes_made"], str):
         output["changes_made"] = [output["changes_made"]]
-
     return output
 
 
-# Executes a RAG-enhanced generation request to Ollama.
-def exec_ollama_rag(prompt_input, ollama_ip, ollama_port, title, description, context, model):
+# Runs one generation on an Ollama server and returns a GenerationResult. HTTP errors are
+# raised (the router retries them on another endpoint); invalid answers are generated again.
+# `options` override the Modelfile parameters for this request (see variant_options).
+def generate(ollama_ip, ollama_port, model, prompt, max_json_retries=None, options=None, keep_alive=None):
     url = f"http://{ollama_ip}:{ollama_port}/api/generate"
+    retries = MAX_JSON_RETRIES if max_json_retries is None else max_json_retries
+    payload = {"model": model, "prompt": prompt, "stream": False, "format": OLLAMA_FORMAT}
+    if options:
+        payload["options"] = options
+    if keep_alive is not None:
+        payload["keep_alive"] = keep_alive
 
-    # Prompt construction (Spanish content preserved, variables updated to English)
-    prompt = (
-        f"source_title: {title}\n"
-        f"target_word_count: {len(description.split())}\n"
-        f"context: {context}\n"
-        "INSTRUCCIONES: Genera un JSON siguiendo las reglas definidas en el Modelfile."
-    )
+    result = GenerationResult(model=model)
+    start = time.monotonic()
+    try:
+        while result.attempts <= retries:
+            result.attempts += 1
+            response = http_sessions.post(http_sessions.OLLAMA, url, json=payload)
+            response.raise_for_status()
+            data = response.json()
+            result.add_timings(data)
+            result.raw_text = data.get("response", "")
+            result.output = parse_output(result.raw_text)
+            if result.output is not None:
+                break
+        if result.output is None:
+            result.error = "The LLM did not return text" if not result.raw_text.strip() else "Could not parse JSON"
+    finally:
+        result.latency_sec = time.monotonic() - start
 
-    response = requests.post(
-        url,
-        json={"model": model, "prompt": prompt},
-        stream=True
-    )
+    if not result.ok:
+        print(f"{result.error} ({result.attempts} attempts). Raw response:")
+        print(result.raw_text)
+        count_error()
+    metrics.record(result)
+    return result
+
+
+# Executes a standard (No-RAG) generation request to Ollama. Returns the GenerationResult
+# (result.output is None when the answer could not be used).
+def exec_ollama(prompt_input, ollama_ip, ollama_port, title, description, model, options=None, keep_alive=None):
+    return generate(ollama_ip, ollama_port, model, build_prompt(title, description), options=options, keep_alive=keep_alive)
+
+
+# Executes a RAG-enhanced generation request to Ollama. Returns the GenerationResult.
+def exec_ollama_rag(prompt_input, ollama_ip, ollama_port, title, description, context, model, options=None, keep_alive=None):
+    return generate(ollama_ip, ollama_port, model, build_prompt(title, description, context), options=options, keep_alive=keep_alive)
+
+
+# Whether a request error is a 4xx answer of the server (connection errors, timeouts and 5xx
+# are failures of the endpoint)
+def is_client_error(error):
+    response = getattr(error, "response", None)
+    return isinstance(error, requests.exceptions.HTTPError) and response is not None and 400 <= response.status_code < 500
+
+
+# Raised when no healthy Ollama endpoint serves the requested model.
+class NoBackendAvailable(Exception):
+    pass
+
+
+# One Ollama server. `models` is filled by the router health checks from /api/tags.
+class OllamaEndpoint:
+    def __init__(self, ip, port, max_inflight=1):
+        self.ip = ip
+        self.port = int(port)
+        self.max_inflight = max_inflight
+        self.models = set()
+        self.inflight = 0
+        self.healthy = False
+        # Last model requested on the endpoint and number of times it changed
+        self.last_model = None
+        self.model_switches = 0
+
+    @property
+    def name(self):
+        return f"{self.ip}:{self.port}"
 
-    full_text = ""
-    for line in response.iter_lines():
-        if not line:
+    def serves(self, model):
+        return _normalize_model_name(model) in self.models
+
+
+def _normalize_model_name(model):
+    model = model.lower()
+    return model[:-len(":latest")] if model.endswith(":latest") else model
+
+
+# Parses "ip:port,ip:port" into a list of endpoints.
+def parse_endpoints(spec, max_inflight=1):
+    endpoints = []
+    for item in spec.split(","):
+        item = item.strip()
+        if not item:
             continue
-        try:
-            data = json.loads(line.decode("utf-8"))
-        except json.JSONDecodeError:
-            continue  # ignore non-JSON lines
-        
-        # Concatenate partial texts
-        if "response" in data and data["response"]:
-            full_text += data["response"]
-
-    if not full_text.strip():
-        print("The LLM did not return text")
-        return None
+        ip, port = item.rsplit(":", 1)
+        endpoints.append(OllamaEndpoint(ip, port, max_inflight))
+    return endpoints
 
-    # Parse final JSON
-    try:
-        full_text = full_text.strip()
-        full_text = re.sub(r"^```json\s*|```$", "", full_text, flags=re.MULTILINE).strip()
-        output = json.loads(full_text.strip())
-    except json.JSONDecodeError:
-        print("Could not parse JSON. Raw response:")
-        print(full_text)
-        
-        # Handling the global counter
-        global error_count
-        error_count += 1
 
-        return None
-    
-    # Normalize fields
-    if "changes_made" in output and isinstance(output["changes_made"], str):
-        output["changes_made"] = [output["changes_made"]]
+# Routes generation requests across several Ollama servers. Each request goes to the
+# least-busy healthy endpoint that serves the model; if the call fails with a connection
+# error, a timeout or a 5xx the endpoint is marked unhealthy until the next health check and
+# the request is retried on another endpoint. 4xx answers are raised to the caller.
+class OllamaRouter:
+    def __init__(self, endpoints, health_interval=60, health_timeout=5):
+        if not endpoints:
+            raise ValueError("At least one Ollama endpoint is required")
+        self.endpoints = endpoints
+        self.health_interval = health_interval
+        self.health_timeout = health_timeout
+        self._cond = threading.Condition()
+        self._refresh_lock = threading.Lock()
+        self._last_refresh = 0.0
+
+    @property
+    def capacity(self):
+        return sum(endpoint.max_inflight for endpoint in self.endpoints)
+
+    # Health check: an endpoint is healthy if /api/tags answers, and serves the models it lists.
+    def refresh(self):
+        with self._refresh_lock:
+            for endpoint in self.endpoints:
+                url = f"http://{endpoint.ip}:{endpoint.port}/api/tags"
+                try:
+                    response = http_sessions.get(http_sessions.OLLAMA, url, timeout=self.health_timeout)
+                    response.raise_for_status()
+                    models = {_normalize_model_name(m["name"]) for m in response.json().get("models", [])}
+                    healthy = True
+                except (requests.exceptions.RequestException, ValueError, KeyError) as e:
+                    print(f"Ollama endpoint {endpoint.name} unavailable: {e}")
+                    models = endpoint.models
+                    healthy = False
+                with self._cond:
+                    endpoint.models = models
+                    endpoint.healthy = healthy
+                    self._cond.notify_all()
+            self._last_refresh = time.monotonic()
+
+    def _maybe_refresh(self):
+        if time.monotonic() - self._last_refresh >= self.health_interval:
+            self.refresh()
+
+    # Blocks until an endpoint serving `model` has a free slot and reserves it.
+    def acquire(self, model, exclude=()):
+        with self._cond:
+            while True:
+                candidates = [e for e in self.endpoints if e.healthy and e.serves(model) and e.name not in exclude]
+                if not candidates:
+                    raise NoBackendAvailable(f"No healthy Ollama endpoint serves '{model}'")
+                free = [e for e in candidates if e.inflight < e.max_inflight]
+                if free:
+                    # Endpoints that already run the model are preferred, then the least busy
+                    requested = _normalize_model_name(model)
+                    endpoint = min(free, key=lambda e: (e.last_model != requested, e.inflight / e.max_inflight))
+                    endpoint.inflight += 1
+                    if endpoint.last_model is not None and endpoint.last_model != requested:
+                        endpoint.model_switches += 1
+                    endpoint.last_model = requested
+                    return endpoint
+                self._cond.wait(timeout=self.health_interval)
+
+    # Model changes per endpoint, e.g. "localhost:11434: 12 model switches"
+    def switch_summary(self):
+        with self._cond:
+            return ", ".join(f"{e.name}: {e.model_switches} model switches" for e in self.endpoints)
+
+    def release(self, endpoint, failed=False):
+        with self._cond:
+            endpoint.inflight -= 1
+            if failed:
+                endpoint.healthy = False
+            self._cond.notify_all()
 
-    return output
\ No newline at end of file
+    # Runs `fn(None, ip, port, *args, **kwargs)` on the chosen endpoint, where `fn` is
+    # exec_ollama or exec_ollama_rag and `args` are its arguments after the port.
+    # Returns (GenerationResult, endpoint_name).
+    def generate(self, fn, model, *args, **kwargs):
+        self._maybe_refresh()
+        tried = set()
+        last_error = None
+        refreshed = False
+        while True:
+            try:
+                endpoint = self.acquire(model, exclude=tried)
+            except NoBackendAvailable:
+                # Endpoints marked unhealthy may have recovered since the last check
+                if not refreshed:
+                    self.refresh()
+                    refreshed = True
+                    continue
+                if last_error is not None:
+                    raise last_error
+                raise
+            try:
+                result = fn(None, endpoint.ip, endpoint.port, *args, **kwargs)
+            except requests.exceptions.RequestException as e:
+                # A 4xx is an error of the request (e.g. unknown model or bad options): another
+                # endpoint would answer the same, and this one is still healthy
+                if is_client_error(e):
+                    self.release(endpoint)
+                    raise
+                print(f"Ollama endpoint {endpoint.name} failed for '{model}': {e}. Retrying on another endpoint.")
+                self.release(endpoint, failed=True)
+                tried.add(endpoint.name)
+                last_error = e
+                continue
+            self.release(endpoint)
+            return result, endpoint.name
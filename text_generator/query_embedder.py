@@ -0,0 +1,39 @@
+from sentence_transformers import SentenceTransformer
+
+# Local query-embedding stage for the RAG retrieval. Encodes all the headlines of a
+# newspaper/day in one batched call and searches Chroma with the embeddings, instead of
+# letting Chroma embed one query text per call.
+#
+# e5 models expect "query: " / "passage: " prefixes and normalized embeddings. Collections
+# created by embeddings/generate_embeddings.py carry the metadata
+# {"embedding_format": "e5"} and were built that way; older collections were embedded
+# from the raw text, so their queries are encoded the same way (no prefix, no normalization).
+
+MODEL_NAME = "intfloat/multilingual-e5-large"
+EMBEDDING_FORMAT_KEY = "embedding_format"
+E5_FORMAT = "e5"
+E5_QUERY_PREFIX = "query: "
+
+
+def is_e5_collection(collection):
+    return (collection.metadata or {}).get(EMBEDDING_FORMAT_KEY) == E5_FORMAT
+
+
+class QueryEmbedder:
+    def __init__(self, model_name=MODEL_NAME, batch_size=32, device="cpu"):
+        self.model = SentenceTransformer(model_name, device=device)
+        self.batch_size = batch_size
+
+    # Encodes the query texts for `collection` in one batched call.
+    def embed(self, collection, texts):
+        e5 = is_e5_collection(collection)
+        if e5:
+            texts = [E5_QUERY_PREFIX + text for text in texts]
+        embeddings = self.model.encode(
+            texts,
+            batch_size=self.batch_size,
+            convert_to_numpy=True,
+            normalize_embeddings=e5,
+            show_progress_bar=False,
+        )
+        return embeddings.tolist()
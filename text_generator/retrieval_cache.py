@@ -0,0 +1,185 @@
+import json
+import os
+import re
+import threading
+from collections import OrderedDict
+
+# Retrieval cache for the RAG path. Stores the Chroma query results keyed by
+# collection + normalized query text + n_results + filters in an in-process LRU, so each
+# headline is embedded and searched once per run. Optionally the cache is loaded
+# from and saved to a JSON file to be reused across runs.
+#
+# Filters use the metadata written by embeddings/generate_embeddings.py (date_stored,
+# newspaper, news_id):
+#   before       - per query, only passages stored strictly before this timestamp (the
+#                  date_stored of the headline), so a news item never sees later news or itself
+#   max_age      - seconds before `before` that are still searched (None = no lower bound)
+#   max_distance - passages farther than this from the query are dropped
+# The misses of a batch are embedded in one call and searched with one Chroma query per
+# time window, so every cached result was computed with the exact filter of its key.
+# Collections embedded without metadata (e.g. the counter-id collections of the first
+# ingestion script) are searched without the time filter, with a warning.
+
+# Collection with the news of every newspaper (generate_embeddings.py --cross_newspaper)
+CROSS_NEWSPAPER_COLLECTION = "real_news_data_all"
+
+
+def normalize_query(text):
+    return re.sub(r'\s+', ' ', text).strip().lower()
+
+
+# Filters of one query (part of its cache key), or None when it has none
+def query_filters(before=None, max_age=None, max_distance=None):
+    filters = {}
+    if before is not None:
+        filters["before"] = int(before)
+        if max_age:
+            filters["after"] = int(before) - int(max_age)
+    if max_distance is not None:
+        filters["max_distance"] = float(max_distance)
+    return filters or None
+
+
+# Time window (before, after) of a query's filters, (None, None) without time filter
+def time_window(filters):
+    filters = filters or {}
+    return filters.get("before"), filters.get("after")
+
+
+# Chroma `where` of a time window, None without time filter
+def window_where(before, after):
+    if before is None:
+        return None
+    conditions = [{"date_stored": {"$lt": before}}]
+    if after is not None:
+        conditions.append({"date_stored": {"$gte": after}})
+    return conditions[0] if len(conditions) == 1 else {"$and": conditions}
+
+
+# Documents of one query result within the distance cut-off, best first
+def filter_results(documents, distances, filters):
+    max_distance = (filters or {}).get("max_distance")
+    if max_distance is None:
+        return documents
+    return [document for document, distance in zip(documents, distances) if distance <= max_distance]
+
+
+# True when the collection has passages with date_stored metadata
+def has_time_metadata(collection):
+    return bool(collection.get(where={"date_stored": {"$gte": 0}}, limit=1, include=["metadatas"])["ids"])
+
+
+class RetrievalCache:
+    def __init__(self, max_entries=10000, path=None):
+        self.max_entries = max_entries
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        # collection name -> whether it can be filtered by time (checked once per run)
+        self._time_metadata = {}
+        if path and os.path.exists(path):
+            self.load()
+
+    @staticmethod
+    def make_key(collection_name, query_text, n_results, filters=None):
+        parts = [collection_name, normalize_query(query_text), str(n_results)]
+        if filters:
+            parts.append(json.dumps(filters, sort_keys=True))
+        return "\x1f".join(parts)
+
+    def get(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def supports_time_filter(self, collection):
+        with self._lock:
+            known = self._time_metadata.get(collection.name)
+        if known is None:
+            known = has_time_metadata(collection)
+            if not known:
+                print(f"WARNING: collection {collection.name} has no date_stored metadata; it is searched without the time filter "
+                      f"(re-embed it with embeddings/generate_embeddings.py to enable it)")
+            with self._lock:
+                self._time_metadata[collection.name] = known
+        return known
+
+    # Returns, for each query text, the results["documents"] that collection.query() gives for
+    # that text alone (after the filters, see above). Cache misses are embedded in one batch
+    # with `embedder` and searched with one Chroma call per time window.
+    def query_batch(self, collection, query_texts, embedder, n_results=10, before=None, max_age=None, max_distance=None):
+        if before is not None and not self.supports_time_filter(collection):
+            before = None
+        filters = [query_filters(before[i] if before else None, max_age, max_distance) for i in range(len(query_texts))]
+        keys = [self.make_key(collection.name, text, n_results, filters[i]) for i, text in enumerate(query_texts)]
+        documents = [self.get(key) for key in keys]
+
+        missing = {}
+        for i, key in enumerate(keys):
+            if documents[i] is None:
+                missing.setdefault(key, []).append(i)
+
+        if missing:
+            missing_keys = list(missing)
+            embeddings = embedder.embed(collection, [query_texts[missing[key][0]] for key in missing_keys])
+
+            # Misses that share a time window are searched together
+            windows = {}
+            for position, key in enumerate(missing_keys):
+                windows.setdefault(time_window(filters[missing[key][0]]), []).append(position)
+
+            for (window_before, window_after), positions in windows.items():
+                results = collection.query(
+                    query_embeddings=[embeddings[position] for position in positions],
+                    n_results=n_results,
+                    where=window_where(window_before, window_after),
+                    include=["documents", "distances"],
+                )
+                for position, docs, distances in zip(positions, results["documents"], results["distances"]):
+                    key = missing_keys[position]
+                    value = [filter_results(docs, distances, filters[missing[key][0]])]
+                    self.put(key, value)
+                    for i in missing[key]:
+                        documents[i] = value
+        return documents
+
+    def query(self, collection, query_text, embedder, n_results=10, before=None, max_age=None, max_distance=None):
+        return self.query_batch(collection, [query_text], embedder, n_results, [before] if before is not None else None, max_age, max_distance)[0]
+
+    def load(self):
+        with open(self.path, 'r', encoding='utf-8') as f:
+            entries = json.load(f)
+        with self._lock:
+            for key, value in entries.items():
+                self._entries[key] = value
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    # Writes the cache to `path` (atomically) if persistence is enabled.
+    def save(self):
+        if not self.path:
+            return
+        with self._lock:
+            entries = dict(self._entries)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(entries, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+    def summary(self):
+        total = self.hits + self.misses
+        ratio = self.hits / total if total else 0.0
+        return f"{self.hits} hits, {self.misses} misses ({ratio:.1%} hit rate)"
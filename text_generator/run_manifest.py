@@ -0,0 +1,56 @@
+import json
+import os
+import threading
+
+# Run manifest (checkpoint journal) for the generators. Every synthetic document that the
+# storage API confirms is appended to a JSONL file as (id_news, id_feature, id_llm, RAG),
+# so a run that is restarted with --resume skips the generations that are already stored.
+
+
+class RunManifest:
+    def __init__(self, path):
+        self.path = path
+        self._done = set()
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue  # ignore a truncated last line after a crash
+                    self._done.add(self._key(entry["id_news"], entry["id_feature"], entry["id_llm"], entry["RAG"]))
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._file = open(path, 'a', encoding='utf-8')
+
+    @staticmethod
+    def _key(id_news, id_feature, id_llm, rag):
+        return (str(id_news), int(id_feature), int(id_llm), int(rag))
+
+    def __len__(self):
+        return len(self._done)
+
+    def is_done(self, id_news, id_feature, id_llm, rag):
+        return self._key(id_news, id_feature, id_llm, rag) in self._done
+
+    # Records the documents of a bulk flush that were stored (or already existed).
+    # `results` is the per-document list returned by the bulk endpoint, None if the flush failed.
+    def record(self, documents, results):
+        if results is None:
+            return
+        stored = [d for d, r in zip(documents, results) if "error" not in r]
+        with self._lock:
+            for document in stored:
+                key = self._key(document["id_news"], document["id_feature"], document["id_llm"], document["RAG"])
+                if key in self._done:
+                    continue
+                self._done.add(key)
+                self._file.write(json.dumps({"id_news": key[0], "id_feature": key[1], "id_llm": key[2], "RAG": key[3]}) + "\n")
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def close(self):
+        with self._lock:
+            self._file.close()
@@ -1,7 +1,8 @@
 import requests
-from datetime import datetime, timedelta
+from datetime import datetime
 
-BASE_URL = "http://localhost:5010/news/{source}?date={date}&shour=00&sminute=0&ehour=23&eminute=00"
+# Totales por día y por fuente con una sola llamada al endpoint /news/counts del data engine
+COUNTS_URL = "http://localhost:5010/news/counts"
 
 # Fuentes a consultar
 sources = ["El_Pais", "El_Mundo", "ABC", "El_Correo", "La_Vanguardia", "La_Verdad"]
@@ -10,33 +11,26 @@ sources = ["El_Pais", "El_Mundo", "ABC", "El_Correo", "La_Vanguardia", "La_Verda
 start_date = datetime(2025, 9, 26)
 end_date = datetime(2025, 10, 25)
 
-current = start_date
+params = {
+    "start": start_date.strftime("%d-%m-%Y"),
+    "end": end_date.strftime("%d-%m-%Y"),
+    "newspapers": ",".join(sources),
+}
 
-# Acumulador total por fuente
-totals = {source: 0 for source in sources}
+print(f"Consultando: {COUNTS_URL} {params}")
 
-while current <= end_date:
-    formatted_date = current.strftime("%d-%m-%Y")
+try:
+    response = requests.get(COUNTS_URL, params=params, timeout=60)
+    response.raise_for_status()
+    data = response.json()
+except requests.exceptions.RequestException as e:
+    print(f"Error al consultar los totales: {e}")
+    raise SystemExit(1)
 
-    for source in sources:
-        url = BASE_URL.format(source=source, date=formatted_date)
-        print(f"Consultando: {url}")
-
-        try:
-            response = requests.get(url, timeout=10)
-            response.raise_for_status()
-            data = response.json()
-
-            total_items = data.get("total_items", 0)
-            totals[source] += total_items
-
-            print(f"  {source} {formatted_date}: total_items={total_items}")
-
-        except requests.exceptions.RequestException as e:
-            print(f"Error al consultar {source} {formatted_date}: {e}")
-
-    current += timedelta(days=1)
+for source in sources:
+    for day, total_items in data["counts"].get(source, {}).items():
+        print(f"  {source} {day}: total_items={total_items}")
 
 print("\n=== RESULTADOS FINALES ===")
 for source in sources:
-    print(f"{source}: {totals[source]} total_items")
+    print(f"{source}: {data['totals'].get(source, 0)} total_items")